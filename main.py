@@ -1,8 +1,12 @@
-import os, time, json, sqlite3, subprocess, tempfile, shutil, re, sys, importlib
+import os, time, json, sqlite3, subprocess, tempfile, shutil, re, sys, importlib, zlib, struct
+import multiprocessing, threading, queue, random, atexit
+from concurrent.futures import ThreadPoolExecutor
 
 
 def ensure_deps():
     pkgs = ["requests", "yt_dlp"]
+    if os.environ.get("TEXT_CODEC") == "zstd":
+        pkgs.append("zstandard")
     missing = [p for p in pkgs if importlib.util.find_spec(p) is None]
     if missing:
         subprocess.check_call([sys.executable, "-m", "pip", "install", *missing])
@@ -19,6 +23,16 @@ ensure_deps()
 import requests
 from yt_dlp import YoutubeDL
 
+try:
+    import zstandard
+except ImportError:   # нужен только при TEXT_CODEC=zstd
+    zstandard = None
+
+try:
+    import orjson
+except ImportError:   # необязателен: без него разбор через стандартный json
+    orjson = None
+
 # ===== ENV =====
 BOT_TOKEN    = os.environ["BOT_TOKEN"]
 LOG_CHAT     = os.environ.get("LOG_CHAT", "")     # чат/группа для логов (устаревший)
@@ -28,6 +42,127 @@ DEBUG        = int(os.environ.get("DEBUG", "1"))
 RAW_UPDATES  = os.environ.get("RAW_UPDATES", "updates.ndjson")
 MEDIA_CACHE_DIR = os.environ.get("MEDIA_CACHE_DIR", "media_cache")
 CACHE_TTL_DAYS  = int(os.environ.get("CACHE_TTL_DAYS", "7"))
+MEDIA_WORKERS       = int(os.environ.get("MEDIA_WORKERS", "2"))         # одновременно качаем/кодируем
+MEDIA_QUEUE_MAX     = int(os.environ.get("MEDIA_QUEUE_MAX", "16"))      # всего задач в работе и в очереди
+MEDIA_JOBS_PER_USER = int(os.environ.get("MEDIA_JOBS_PER_USER", "2"))
+MEDIA_JOBS_PER_CHAT = int(os.environ.get("MEDIA_JOBS_PER_CHAT", "3"))
+MEDIA_DEADLINE_SEC  = int(os.environ.get("MEDIA_DEADLINE_SEC", "300"))  # задачи старше — отбрасываются
+MEDIA_MAX_MB        = int(os.environ.get("MEDIA_MAX_MB", "20"))         # getFile Bot API отдаёт файлы до 20 МБ
+MEDIA_MAX_DURATION  = int(os.environ.get("MEDIA_MAX_DURATION", "600"))  # секунд
+SEARCH_PAGE_SIZE = int(os.environ.get("SEARCH_PAGE_SIZE", "5"))
+RETENTION_DAYS  = int(os.environ.get("RETENTION_DAYS", "0"))      # 0 — хранить сообщения бессрочно
+RETENTION_RULES = os.environ.get("RETENTION_RULES", "")          # "chat:123=30,bcid:AbC=365" (0 — бессрочно)
+MAINTENANCE_INTERVAL = int(os.environ.get("MAINTENANCE_INTERVAL", "60"))
+RETENTION_BATCH      = int(os.environ.get("RETENTION_BATCH", "500"))
+VACUUM_STEP_PAGES    = int(os.environ.get("VACUUM_STEP_PAGES", "256"))
+TEXT_CODEC         = os.environ.get("TEXT_CODEC", "")             # "zstd" — сжимать тексты словарём zstd
+CODEC_DICT_SIZE    = int(os.environ.get("CODEC_DICT_SIZE", "65536"))
+CODEC_TRAIN_ROWS   = int(os.environ.get("CODEC_TRAIN_ROWS", "50000"))
+CODEC_RETRAIN_DAYS = int(os.environ.get("CODEC_RETRAIN_DAYS", "7"))   # 0 — переобучать только вручную
+INBOX_DB           = os.environ.get("INBOX_DB", "inbox.sqlite3")
+INBOX_MAX_ATTEMPTS = int(os.environ.get("INBOX_MAX_ATTEMPTS", "5"))
+INBOX_HIGH_WATER   = int(os.environ.get("INBOX_HIGH_WATER", "500"))   # столько необработанных — опрос на паузе
+POLL_LIMIT         = max(1, min(100, int(os.environ.get("POLL_LIMIT", "100"))))  # потолок limit для getUpdates
+WORKERS            = int(os.environ.get("WORKERS", "1"))            # >1 — супервизор + процессы-обработчики
+WORKER_STALL_SEC   = int(os.environ.get("WORKER_STALL_SEC", "900"))  # без heartbeat дольше — перезапуск
+LOG_LEVEL_NAME     = (os.environ.get("LOG_LEVEL") or ("debug" if DEBUG else "info")).lower()   # пустое значение из .env — как не заданное
+LOG_FORMAT         = os.environ.get("LOG_FORMAT", "json")           # json | text
+LOG_SAMPLE         = os.environ.get("LOG_SAMPLE", "tg_call=0.1,tg_upload=0.5,store=0.1,fetch=0.1,business_message.raw=0.01")
+
+# ===== structured logging =====
+# Уровень проверяется до того, как собираются поля; на горячих путях — явным `if LOG_DEBUG_ON:`.
+# Событие кладётся в очередь как есть, а форматирование и запись (json.dumps + stdout) делает
+# фоновый поток. Значение поля может быть функцией без аргументов — она вызовется только в потоке записи.
+LOG_DEBUG, LOG_INFO, LOG_WARNING, LOG_ERROR = 10, 20, 30, 40
+LOG_LEVEL_NAMES = {LOG_DEBUG: "debug", LOG_INFO: "info", LOG_WARNING: "warning", LOG_ERROR: "error"}
+LOG_LEVEL = {v: k for k, v in LOG_LEVEL_NAMES.items()}.get(LOG_LEVEL_NAME, LOG_INFO)
+LOG_DEBUG_ON = LOG_LEVEL <= LOG_DEBUG
+
+def parse_log_sample(spec: str) -> dict:
+    """'tg_call=0.1,store=0.5' -> {"tg_call": 0.1, "store": 0.5}; правило для 'x' действует на 'x.*'"""
+    rates = {}
+    for item in spec.split(","):
+        name, sep, rate = item.strip().partition("=")
+        try:
+            if sep:
+                rates[name] = float(rate)
+        except ValueError:
+            pass
+    return rates
+
+_log_sample = parse_log_sample(LOG_SAMPLE)
+_log_queue: queue.Queue | None = None
+_log_dropped = 0
+
+def _log_format(ts: float, level: int, event: str, fields: dict) -> str:
+    rec = {"ts": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts)) + f".{int(ts % 1 * 1000):03d}",
+           "lvl": LOG_LEVEL_NAMES.get(level, str(level)), "ev": event, "pid": os.getpid()}
+    for k, v in fields.items():
+        rec[k] = v() if callable(v) else v
+    if LOG_FORMAT == "text":
+        extra = " ".join(f"{k}={json.dumps(v, ensure_ascii=False, default=str)}" for k, v in list(rec.items())[4:])
+        return f"[{rec['ts']}] {rec['lvl'].upper():<7} {event} {extra}".rstrip()
+    return json.dumps(rec, ensure_ascii=False, default=str)
+
+def _log_writer(q: queue.Queue):
+    global _log_dropped
+    while True:
+        item = q.get()
+        if item is None:
+            return
+        try:
+            if _log_dropped:
+                n, _log_dropped = _log_dropped, 0
+                sys.stdout.write(_log_format(time.time(), LOG_WARNING, "log.dropped", {"count": n}) + "\n")
+            sys.stdout.write(_log_format(*item) + "\n")
+            if q.empty():
+                sys.stdout.flush()
+        except Exception:
+            pass
+
+def start_log_sink():
+    """Запускает поток записи; каждый обработчик (spawn) заново импортирует модуль и запускает свой"""
+    global _log_queue
+    _log_queue = queue.Queue(maxsize=10000)
+    threading.Thread(target=_log_writer, args=(_log_queue,), name="log-writer", daemon=True).start()
+
+def _log_flush():
+    if _log_queue is not None:
+        _log_queue.put(None)
+        deadline = time.time() + 2
+        while not _log_queue.empty() and time.time() < deadline:
+            time.sleep(0.01)
+        sys.stdout.flush()
+
+def log(level: int, event: str, **fields):
+    global _log_dropped
+    if level < LOG_LEVEL:
+        return
+    rate = _log_sample.get(event)
+    if rate is None and "." in event:
+        rate = _log_sample.get(event.split(".", 1)[0])
+    if rate is not None and level < LOG_WARNING and random.random() >= rate:
+        return
+    try:
+        _log_queue.put_nowait((time.time(), level, event, fields))
+    except queue.Full:
+        _log_dropped += 1   # писатель не успевает — лучше потерять строку, чем тормозить обработку
+
+def log_debug(event: str, **fields):
+    if LOG_DEBUG_ON:
+        log(LOG_DEBUG, event, **fields)
+
+def log_info(event: str, **fields):
+    log(LOG_INFO, event, **fields)
+
+def log_warning(event: str, **fields):
+    log(LOG_WARNING, event, **fields)
+
+def log_error(event: str, **fields):
+    log(LOG_ERROR, event, **fields)
+
+start_log_sink()
+atexit.register(_log_flush)
 
 # ===== Auto owner detection =====
 OWNER_FILE = "owner_id.txt"
@@ -45,11 +180,14 @@ def get_owner_id():
 def save_owner_id(user_id: str):
     """Сохраняет ID владельца в файл"""
     try:
-        with open(OWNER_FILE, "w") as f:
+        # через временный файл: другие процессы не увидят файл наполовину записанным
+        tmp = f"{OWNER_FILE}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
             f.write(str(user_id))
-        d("[owner saved]", {"user_id": user_id})
+        os.replace(tmp, OWNER_FILE)
+        log_info("owner.saved", user_id=user_id)
     except Exception as e:
-        d("[owner save error]", str(e))
+        log_error("owner.save_error", error=repr(e))
 
 API      = f"https://api.telegram.org/bot{BOT_TOKEN}"
 FILE_API = f"https://api.telegram.org/file/bot{BOT_TOKEN}"
@@ -57,7 +195,21 @@ FILE_API = f"https://api.telegram.org/file/bot{BOT_TOKEN}"
 os.makedirs(MEDIA_CACHE_DIR, exist_ok=True)
 
 # ===== DB (текст + медиа) =====
-db = sqlite3.connect("messages.sqlite3", check_same_thread=False)
+DB_PATH = os.environ.get("DB_PATH", "messages.sqlite3")
+
+for _path in (DB_PATH, INBOX_DB):   # базы могут лежать в смонтированном каталоге (data/ в Docker)
+    if os.path.dirname(_path):
+        os.makedirs(os.path.dirname(_path), exist_ok=True)
+
+def connect_db() -> sqlite3.Connection:
+    # WAL + busy timeout: с файлом одновременно работают несколько процессов (WORKERS > 1)
+    conn = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False)
+    # на пустом файле действует сразу (до первой таблицы); на существующей базе — no-op
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+db = connect_db()
 db.execute("""
 CREATE TABLE IF NOT EXISTS biz_messages(
   bcid       TEXT,      -- '' для обычных, business_connection_id для бизнес
@@ -79,36 +231,192 @@ db.commit()
 
 db.execute("CREATE INDEX IF NOT EXISTS idx_biz_chat_msg ON biz_messages(chat_id, msg_id)")
 db.execute("CREATE INDEX IF NOT EXISTS idx_biz_media_type ON biz_messages(media_type)")
+db.execute("CREATE INDEX IF NOT EXISTS idx_biz_date ON biz_messages(date)")
+db.commit()
+
+# Новая база создаётся сразу с auto_vacuum=INCREMENTAL (см. connect_db). У существующей
+# режим меняется только полным VACUUM: на большой базе это долгая перезапись с двойным
+# запасом места, поэтому она не делается при старте, а запускается вручную
+# (python main.py enable-incremental-vacuum). До этого maintenance_tick() файл не ужимает.
+def incremental_vacuum_enabled() -> bool:
+    return db.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+def enable_incremental_vacuum():
+    db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    db.execute("VACUUM")
+
+if __name__ == "__main__" and not incremental_vacuum_enabled():   # только в супервизоре, не в каждом обработчике
+    log_warning("db.auto_vacuum_off", hint="python main.py enable-incremental-vacuum")
+
+# ===== помесячные партиции =====
+# Новые сообщения пишутся в biz_messages_ГГГГММ; старая таблица biz_messages остаётся
+# самой старой партицией. Устаревший месяц удаляется целиком через DROP TABLE.
+PARTITION_PREFIX = "biz_messages_"
+_partitions: list[str] = []   # от новых к старым, последней — biz_messages
+
+def partition_name(ts: float) -> str:
+    return PARTITION_PREFIX + time.strftime("%Y%m", time.localtime(ts))
+
+def load_partitions():
+    names = [r[0] for r in db.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name GLOB 'biz_messages_[0-9][0-9][0-9][0-9][0-9][0-9]'"
+    ).fetchall()]
+    _partitions[:] = sorted(names, reverse=True) + ["biz_messages"]
+
+def partitions() -> list[str]:
+    # текущий месяц мог создать другой процесс — перечитываем список, пока его не видно
+    if partition_name(time.time()) not in _partitions:
+        load_partitions()
+    return _partitions
+
+def ensure_partition(ts: float) -> str:
+    name = partition_name(ts)
+    if name not in _partitions:
+        db.execute(f"""
+        CREATE TABLE IF NOT EXISTS {name}(
+          bcid       TEXT,
+          chat_id    INTEGER,
+          msg_id     INTEGER,
+          date       INTEGER,
+          text       TEXT,
+          media_type TEXT,
+          file_id    TEXT,
+          PRIMARY KEY (bcid, chat_id, msg_id)
+        )
+        """)
+        index_partition(name)
+        load_partitions()
+    return name
+
+def index_partition(name: str):
+    db.execute(f"CREATE INDEX IF NOT EXISTS idx_{name}_chat_msg ON {name}(chat_id, msg_id)")
+    # по date идёт построчная чистка retention в месяце, который пересекает граница хранения
+    db.execute(f"CREATE INDEX IF NOT EXISTS idx_{name}_date ON {name}(date)")
+
+def partition_first(sql: str, args: tuple):
+    """Выполняет запрос (таблица — {t}) по партициям от новых к старым и возвращает первую найденную строку"""
+    for name in list(partitions()):
+        try:
+            row = db.execute(sql.format(t=name), args).fetchone()
+        except sqlite3.OperationalError as e:
+            if "no such table" not in str(e):
+                raise
+            load_partitions()   # партицию удалили в другом процессе
+            continue
+        if row:
+            return row
+    return None
+
+load_partitions()
+for _name in _partitions[:-1]:   # партиции, созданные до появления индекса по date
+    index_partition(_name)
 db.commit()
 
-# ===== debug/log helpers =====
+# ===== история правок =====
+# append-only: правка добавляет ревизию, а не перезаписывает строку в biz_messages.
+# WITHOUT ROWID — строки лежат в B-дереве первичного ключа, т.е. кластеризованы по (chat_id, msg_id),
+# и последняя версия читается одним спуском по ключу без обращения к отдельной таблице.
+db.execute("""
+CREATE TABLE IF NOT EXISTS biz_revisions(
+  chat_id    INTEGER,
+  msg_id     INTEGER,
+  bcid       TEXT,
+  rev        INTEGER,   -- 0 = исходная версия
+  date       INTEGER,
+  body       BLOB,      -- текст как есть (TEXT) или сжатый (BLOB), см. pack_text
+  media_type TEXT,
+  file_id    TEXT,
+  PRIMARY KEY (chat_id, msg_id, bcid, rev)
+) WITHOUT ROWID
+""")
+db.execute("CREATE INDEX IF NOT EXISTS idx_revisions_date ON biz_revisions(date)")
+db.commit()
+
+# ===== словари zstd =====
+# каждая версия словаря хранится навсегда: старые строки распаковываются своим словарём
+db.execute("""
+CREATE TABLE IF NOT EXISTS text_dicts(
+  id      INTEGER PRIMARY KEY,
+  created INTEGER,
+  samples INTEGER,
+  data    BLOB
+)
+""")
+db.commit()
+
+# ===== индекс медиакэша =====
+# одна строка на закэшированный файл вместо <msg_id>.json рядом с каждым файлом;
+# восстанавливается по содержимому media_cache/ (rebuild_media_index)
+db.execute("""
+CREATE TABLE IF NOT EXISTS media_index(
+  chat_id    INTEGER,
+  msg_id     INTEGER,
+  media_type TEXT,
+  file       TEXT,      -- имя файла в media_cache/<chat_id>/
+  size       INTEGER,
+  ts         INTEGER,
+  PRIMARY KEY (chat_id, msg_id)
+) WITHOUT ROWID
+""")
+db.execute("CREATE INDEX IF NOT EXISTS idx_media_index_ts ON media_index(ts)")
+db.commit()
+
+# ===== полнотекстовый поиск (FTS5) =====
+# biz_search_docs — по строке на сообщение, её id = rowid в biz_fts
+db.execute("""
+CREATE TABLE IF NOT EXISTS biz_search_docs(
+  id         INTEGER PRIMARY KEY,
+  bcid       TEXT,
+  chat_id    INTEGER,
+  msg_id     INTEGER,
+  date       INTEGER,
+  media_type TEXT,
+  UNIQUE (bcid, chat_id, msg_id)
+)
+""")
+db.execute("CREATE INDEX IF NOT EXISTS idx_search_docs_chat_date ON biz_search_docs(chat_id, date)")
+db.execute("CREATE INDEX IF NOT EXISTS idx_search_docs_date ON biz_search_docs(date)")
+db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS biz_fts USING fts5(text, tokenize='unicode61 remove_diacritics 2')")
+# сохранённые запросы /search — callback_data ограничен 64 байтами, поэтому в кнопках только id
+db.execute("""
+CREATE TABLE IF NOT EXISTS biz_searches(
+  id         INTEGER PRIMARY KEY,
+  query      TEXT,
+  chat_id    INTEGER,
+  date_from  INTEGER,
+  date_to    INTEGER,
+  media_type TEXT,
+  created    INTEGER
+)
+""")
+db.commit()
+
+if not db.execute("SELECT 1 FROM biz_search_docs LIMIT 1").fetchone():
+    # первичное наполнение индекса уже сохранёнными сообщениями
+    db.execute("""
+        INSERT OR IGNORE INTO biz_search_docs(bcid, chat_id, msg_id, date, media_type)
+        SELECT bcid, chat_id, msg_id, date, media_type FROM biz_messages ORDER BY date
+    """)
+    db.execute("""
+        INSERT INTO biz_fts(rowid, text)
+        SELECT s.id, COALESCE(m.text, '') FROM biz_search_docs s
+        JOIN biz_messages m ON m.bcid = s.bcid AND m.chat_id = s.chat_id AND m.msg_id = s.msg_id
+    """)
+    db.commit()
+
+# ===== raw journal helpers =====
 def _ts() -> str:
     try:
         return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
     except Exception:
         return ""
 
-def d(msg: str, obj=None):
-    if not DEBUG:
-        return
-    try:
-        if obj is None:
-            print(f"[{_ts()}] {msg}")
-        else:
-            try:
-                j = json.dumps(obj, ensure_ascii=False)
-            except Exception:
-                j = str(obj)
-            print(f"[{_ts()}] {msg}: {j}")
-    except Exception:
-        pass
-
 def log_line(path: str, line: str):
     try:
         with open(path, "a", encoding="utf-8") as f:
             f.write(line + "\n")
     except Exception as e:
-        print("[log_line error]", repr(e))
+        log_error("log_line.error", path=path, error=repr(e))
 
 def log_json(path: str, obj):
     try:
@@ -122,105 +430,503 @@ def html_escape(s: str) -> str:
     s = s or ""
     return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
 
-def msg_text(m) -> str:
-    return (m.get("text") or m.get("caption") or "").strip()
-
-def parse_media(m):
-    if "photo" in m and isinstance(m["photo"], list) and m["photo"]:
-        ph = max(m["photo"], key=lambda x: x.get("file_size", 0))
-        return "photo", ph["file_id"]
-    if "video"      in m: return "video",      m["video"]["file_id"]
-    if "document"   in m: return "document",   m["document"]["file_id"]
-    if "voice"      in m: return "voice",      m["voice"]["file_id"]
-    if "audio"      in m: return "audio",      m["audio"]["file_id"]
-    if "animation"  in m: return "animation",  m["animation"]["file_id"]
-    if "video_note" in m: return "video_note", m["video_note"]["file_id"]
-    return None, None
+def json_loads(data):
+    return orjson.loads(data) if orjson else json.loads(data)
 
 def tg_call(method, **params):
-    d("[tg_call start]", {"method": method, "keys": list(params.keys())})
+    if LOG_DEBUG_ON:
+        log(LOG_DEBUG, "tg_call.start", method=method, keys=list(params))
     r = requests.post(f"{API}/{method}", data=params, timeout=60)
     r.raise_for_status()
-    data = r.json()
+    data = json_loads(r.content)
     if not data.get("ok"):
-        d("[tg_call fail]", data)
+        log_error("tg_call.fail", method=method, response=data)
         raise RuntimeError(f"{method} error: {data}")
-    d("[tg_call ok]", {"method": method})
+    if LOG_DEBUG_ON:
+        log(LOG_DEBUG, "tg_call.ok", method=method)
     return data["result"]
 
 def tg_upload(method: str, file_field: str, file_path: str, **params):
-    d("[tg_upload start]", {"method": method, "file_field": file_field, "file": os.path.basename(file_path)})
+    if LOG_DEBUG_ON:
+        log(LOG_DEBUG, "tg_upload.start", method=method, file_field=file_field, file=file_path)
     with open(file_path, "rb") as f:
         files = {file_field: (os.path.basename(file_path), f)}
         r = requests.post(f"{API}/{method}", data=params, files=files, timeout=600)
     r.raise_for_status()
-    data = r.json()
+    data = json_loads(r.content)
     if not data.get("ok"):
-        d("[tg_upload fail]", data)
+        log_error("tg_upload.fail", method=method, response=data)
         raise RuntimeError(f"{method} error: {data}")
-    d("[tg_upload ok]", {"method": method})
+    if LOG_DEBUG_ON:
+        log(LOG_DEBUG, "tg_upload.ok", method=method)
     return data["result"]
 
 def send_log_html(html: str):
     # Приоритет: сначала владельцу бота, потом в группу (если указана)
     target_chat = get_owner_id() or LOG_CHAT
     if not target_chat:
-        print("LOG:", html); return
+        log_info("send_log.no_target", html=html); return
     try:
         tg_call("sendMessage", chat_id=target_chat, text=html, parse_mode="HTML", disable_web_page_preview=True)
     except Exception as e:
-        print("send_log error:", e)
+        log_error("send_log.error", error=repr(e))
+
+# ===== сжатие текста =====
+# Формат BLOB: b"Z" + id словаря (2 байта, 0 — без словаря) + кадр zstd, иначе поток zlib.
+# Первый байт zlib (CMF) никогда не равен b"Z", так что форматы не пересекаются.
+# Несжатый текст хранится обычной строкой (TEXT).
+ZSTD_TAG = b"Z"
+ZSTD_LEVEL = 9
+_zstd_compressor: tuple | None = None   # (id словаря, ZstdCompressor)
+_zstd_decompressors: dict = {}
+_codec_last_train = 0.0
+_codec_checked = 0.0
+CODEC_REFRESH_SEC = 60
+
+def codec_enabled() -> bool:
+    return TEXT_CODEC == "zstd" and zstandard is not None
+
+def _zstd_params(dict_data=None) -> dict:
+    # без контрольной суммы и id словаря в кадре: id уже лежит в нашем заголовке
+    p = {"level": ZSTD_LEVEL, "write_checksum": False, "write_dict_id": False, "write_content_size": True}
+    if dict_data is not None:
+        p["dict_data"] = dict_data
+    return p
+
+def _zstd_dict(dict_id: int):
+    row = db.execute("SELECT data FROM text_dicts WHERE id=?", (dict_id,)).fetchone()
+    if not row:
+        raise RuntimeError(f"zstd dictionary {dict_id} not found")
+    return zstandard.ZstdCompressionDict(row[0])
+
+def load_codec():
+    """Берёт для сжатия самый свежий словарь (или zstd без словаря, пока он не обучен)"""
+    global _zstd_compressor
+    if not codec_enabled():
+        _zstd_compressor = None
+        return
+    row = db.execute("SELECT id FROM text_dicts ORDER BY id DESC LIMIT 1").fetchone()
+    if row:
+        _zstd_compressor = (row[0], zstandard.ZstdCompressor(**_zstd_params(_zstd_dict(row[0]))))
+    else:
+        _zstd_compressor = (0, zstandard.ZstdCompressor(**_zstd_params()))
+
+def refresh_codec():
+    """Словарь обучает процесс, который делает maintenance_tick; остальные (WORKERS > 1)
+    раз в CODEC_REFRESH_SEC проверяют, не появилась ли новая версия, и переключаются на неё"""
+    global _codec_checked
+    now = time.time()
+    if now - _codec_checked < CODEC_REFRESH_SEC:
+        return
+    _codec_checked = now
+    latest = db.execute("SELECT MAX(id) FROM text_dicts").fetchone()[0] or 0
+    if _zstd_compressor is None or _zstd_compressor[0] != latest:
+        load_codec()
+
+def _zstd_decompressor(dict_id: int):
+    dec = _zstd_decompressors.get(dict_id)
+    if dec is None:
+        if dict_id:
+            dec = zstandard.ZstdDecompressor(dict_data=_zstd_dict(dict_id))
+        else:
+            dec = zstandard.ZstdDecompressor()
+        _zstd_decompressors[dict_id] = dec
+    return dec
+
+def pack_text(text: str):
+    """Сжимает текст, если это даёт выигрыш; иначе возвращает строку как есть"""
+    if codec_enabled():
+        refresh_codec()
+    text = text or ""
+    raw = text.encode("utf-8")
+    if _zstd_compressor and raw:
+        dict_id, cctx = _zstd_compressor
+        z = ZSTD_TAG + struct.pack(">H", dict_id) + cctx.compress(raw)
+        if len(z) < len(raw):
+            return z
+    elif len(raw) >= 64:
+        z = zlib.compress(raw, 9)
+        if len(z) < len(raw):
+            return z
+    return text
+
+def unpack_text(body) -> str:
+    if isinstance(body, bytes):
+        if body[:1] == ZSTD_TAG:
+            if zstandard is None:
+                raise RuntimeError("zstandard is required to read compressed messages")
+            dict_id = struct.unpack(">H", body[1:3])[0]
+            return _zstd_decompressor(dict_id).decompress(body[3:]).decode("utf-8")
+        return zlib.decompress(body).decode("utf-8")
+    return body or ""
+
+def sample_texts(limit: int) -> list[bytes]:
+    """Последние тексты из партиций (от новых к старым) — выборка для обучения словаря"""
+    out = []
+    for name in list(partitions()):
+        for (body,) in db.execute(f"SELECT text FROM {name} WHERE text IS NOT NULL AND text != '' ORDER BY rowid DESC LIMIT ?",
+                                  (limit - len(out),)):
+            out.append(unpack_text(body).encode("utf-8"))
+        if len(out) >= limit:
+            break
+    return out
+
+def _train_dict(samples: list[bytes]):
+    # словарь не должен быть больше ~1% выборки, иначе zstd обучает его плохо или отказывается
+    size = min(CODEC_DICT_SIZE, max(4096, sum(map(len, samples)) // 100))
+    return zstandard.train_dictionary(size, samples)
+
+def train_text_dict(limit: int = CODEC_TRAIN_ROWS) -> int | None:
+    """Обучает новую версию словаря на свежих сообщениях; новые записи сразу сжимаются ей"""
+    global _codec_last_train
+    if not codec_enabled():
+        return None
+    _codec_last_train = time.time()
+    samples = sample_texts(limit)
+    try:
+        zd = _train_dict(samples)
+    except zstandard.ZstdError as e:
+        log_warning("codec.train_skipped", samples=len(samples), error=str(e))
+        return None
+    dict_id = db.execute(
+        "INSERT INTO text_dicts(created, samples, data) VALUES(?,?,?)", (int(time.time()), len(samples), zd.as_bytes())
+    ).lastrowid
+    db.commit()
+    load_codec()
+    log_info("codec.trained", dict=dict_id, samples=len(samples), size=len(zd.as_bytes()))
+    return dict_id
+
+def codec_tick(now: int):
+    """Автоматическое (пере)обучение словаря из maintenance_tick"""
+    if not codec_enabled():
+        return
+    if now - _codec_last_train < 3600:
+        return   # неудачное обучение не повторяем на каждом тике
+    row = db.execute("SELECT created FROM text_dicts ORDER BY id DESC LIMIT 1").fetchone()
+    if row is None or (CODEC_RETRAIN_DAYS and now - row[0] > CODEC_RETRAIN_DAYS * 86400):
+        train_text_dict()
+
+def bench_codec(limit: int = CODEC_TRAIN_ROWS):
+    """python main.py bench-codec — экономия места и CPU на операцию для вариантов хранения текста.
+    Словарь обучается на половине выборки, замер идёт на другой половине."""
+    texts = sample_texts(limit)
+    if len(texts) < 2:
+        print("bench-codec: недостаточно сообщений в БД")
+        return
+    train, test = texts[0::2], texts[1::2]
+    raw_total = sum(map(len, test))
+    variants = [("zlib-9", lambda b: zlib.compress(b, 9), zlib.decompress)]
+    if zstandard is None:
+        print("bench-codec: zstandard не установлен, замеряю только zlib")
+    else:
+        c = zstandard.ZstdCompressor(**_zstd_params())
+        variants.append(("zstd", c.compress, zstandard.ZstdDecompressor().decompress))
+        try:
+            zd = _train_dict(train)
+            cd = zstandard.ZstdCompressor(**_zstd_params(zd))
+            variants.append((f"zstd+dict{len(zd.as_bytes()) // 1024}k", cd.compress,
+                             zstandard.ZstdDecompressor(dict_data=zd).decompress))
+        except zstandard.ZstdError as e:
+            print("bench-codec: словарь не обучился:", e)
+
+    print(f"сообщений: {len(test)}, исходный размер: {raw_total} байт, средний: {raw_total / len(test):.1f} байт")
+    # biz_fts хранит свою несжатую копию каждого текста, поэтому по файлу в целом выигрыш меньше
+    fts_bytes = db.execute("SELECT COALESCE(SUM(length(CAST(text AS BLOB))), 0) FROM biz_fts").fetchone()[0]
+    print(f"несжатая копия текстов в biz_fts: {fts_bytes} байт; «доля с FTS» — тексты сообщений вместе с ней")
+    print(f"{'кодек':<16}{'размер':>10}{'доля':>8}{'доля с FTS':>12}{'сжатие, мкс':>14}{'распаковка, мкс':>17}")
+    for name, comp, decomp in variants:
+        t0 = time.perf_counter()
+        packed = [comp(b) for b in test]
+        t1 = time.perf_counter()
+        for z in packed:
+            decomp(z)
+        t2 = time.perf_counter()
+        # как в pack_text: заголовок 3 байта, несжимаемое хранится как есть
+        stored = sum(min(len(z) + 3, len(b)) for z, b in zip(packed, test))
+        print(f"{name:<16}{stored:>10}{stored / raw_total:>8.1%}{(stored + raw_total) / (2 * raw_total):>12.1%}"
+              f"{(t1 - t0) / len(test) * 1e6:>14.1f}{(t2 - t1) / len(test) * 1e6:>17.1f}")
+
+load_codec()
+
+def fts_sync(bcid, chat_id, msg_id, date, text, media_type=None):
+    """Обновляет поисковый индекс для одного сообщения (без commit)"""
+    text = text or ""
+    row = db.execute(
+        "SELECT id FROM biz_search_docs WHERE bcid=? AND chat_id=? AND msg_id=?",
+        (bcid, chat_id, msg_id)
+    ).fetchone()
+    if not row:
+        doc_id = db.execute(
+            "INSERT INTO biz_search_docs(bcid,chat_id,msg_id,date,media_type) VALUES(?,?,?,?,?)",
+            (bcid, chat_id, msg_id, date, media_type)
+        ).lastrowid
+        db.execute("INSERT INTO biz_fts(rowid, text) VALUES(?,?)", (doc_id, text))
+        return
+    doc_id = row[0]
+    # дата остаётся датой первого сохранения, меняется только тип медиа и текст
+    db.execute("UPDATE biz_search_docs SET media_type=? WHERE id=?", (media_type, doc_id))
+    old = db.execute("SELECT text FROM biz_fts WHERE rowid=?", (doc_id,)).fetchone()
+    if old and old[0] == text:
+        return
+    db.execute("DELETE FROM biz_fts WHERE rowid=?", (doc_id,))
+    db.execute("INSERT INTO biz_fts(rowid, text) VALUES(?,?)", (doc_id, text))
 
 def store(bcid, chat_id, msg_id, text, media_type=None, file_id=None):
+    # у сообщения уже есть история правок — fetch() читает её голову, поэтому новая версия
+    # (например, скачанный по ссылке файл после правки текста) дописывается ревизией
+    if db.execute("SELECT 1 FROM biz_revisions WHERE chat_id=? AND msg_id=? AND bcid=? LIMIT 1",
+                  (chat_id, msg_id, bcid)).fetchone():
+        store_edit(bcid, chat_id, msg_id, text, media_type, file_id)
+        return
+    now = int(time.time())
+    db.execute(
+        f"INSERT OR REPLACE INTO {ensure_partition(now)}(bcid,chat_id,msg_id,date,text,media_type,file_id) VALUES(?,?,?,?,?,?,?)",
+        (bcid, chat_id, msg_id, now, pack_text(text) if codec_enabled() else (text or ""), media_type, file_id)
+    )
+    fts_sync(bcid, chat_id, msg_id, now, text, media_type)
+    db.commit()
+    if LOG_DEBUG_ON:
+        log(LOG_DEBUG, "store", bcid=bcid, chat=chat_id, msg=msg_id, has_text=bool(text), media=media_type)
+
+def store_edit(bcid, chat_id, msg_id, text, media_type=None, file_id=None):
+    """Дописывает новую версию сообщения в biz_revisions; biz_messages не трогаем"""
+    now  = int(time.time())
+    text = text or ""
+    head = db.execute(
+        "SELECT rev, body, media_type, file_id FROM biz_revisions WHERE chat_id=? AND msg_id=? AND bcid=? ORDER BY rev DESC LIMIT 1",
+        (chat_id, msg_id, bcid)
+    ).fetchone()
+    if head:
+        if unpack_text(head[1]) == text and (head[2], head[3]) == (media_type, file_id):
+            return
+        rev = head[0] + 1
+    else:
+        # первая правка: исходная версия из biz_messages становится ревизией 0
+        base = partition_first(
+            "SELECT date, text, media_type, file_id FROM {t} WHERE bcid=? AND chat_id=? AND msg_id=?",
+            (bcid, chat_id, msg_id)
+        )
+        rev = 0
+        if base:
+            db.execute(
+                "INSERT INTO biz_revisions(chat_id,msg_id,bcid,rev,date,body,media_type,file_id) VALUES(?,?,?,?,?,?,?,?)",
+                (chat_id, msg_id, bcid, 0, base[0], pack_text(unpack_text(base[1])), base[2], base[3])
+            )
+            rev = 1
     db.execute(
-        "INSERT OR REPLACE INTO biz_messages(bcid,chat_id,msg_id,date,text,media_type,file_id) VALUES(?,?,?,?,?,?,?)",
-        (bcid, chat_id, msg_id, int(time.time()), text or "", media_type, file_id)
+        "INSERT INTO biz_revisions(chat_id,msg_id,bcid,rev,date,body,media_type,file_id) VALUES(?,?,?,?,?,?,?,?)",
+        (chat_id, msg_id, bcid, rev, now, pack_text(text), media_type, file_id)
     )
+    fts_sync(bcid, chat_id, msg_id, now, text, media_type)
     db.commit()
-    d("[store]", {"bcid": bcid, "chat": chat_id, "msg": msg_id, "has_text": bool(text), "media": media_type})
+    log_debug("store.edit", bcid=bcid, chat=chat_id, msg=msg_id, rev=rev)
+
+def fetch_revision(bcid, chat_id, msg_id):
+    """Последняя версия из biz_revisions или None, если сообщение не редактировалось"""
+    if bcid is None:
+        row = db.execute(
+            "SELECT body, media_type, file_id FROM biz_revisions WHERE chat_id=? AND msg_id=? ORDER BY date DESC, rev DESC LIMIT 1",
+            (chat_id, msg_id)
+        ).fetchone()
+    else:
+        row = db.execute(
+            "SELECT body, media_type, file_id FROM biz_revisions WHERE chat_id=? AND msg_id=? AND bcid=? ORDER BY rev DESC LIMIT 1",
+            (chat_id, msg_id, bcid)
+        ).fetchone()
+    if row:
+        return unpack_text(row[0]), row[1], row[2]
+    return None
+
+def fetch_history(chat_id, msg_id):
+    """Все версии сообщения: [(bcid, rev, date, text, media_type)], от старых к новым"""
+    rows = db.execute(
+        "SELECT bcid, rev, date, body, media_type FROM biz_revisions WHERE chat_id=? AND msg_id=? ORDER BY bcid, rev",
+        (chat_id, msg_id)
+    ).fetchall()
+    if rows:
+        return [(bcid, rev, date, unpack_text(body), mtype) for bcid, rev, date, body, mtype in rows]
+    row = partition_first("SELECT bcid, date, text, media_type FROM {t} WHERE chat_id=? AND msg_id=?", (chat_id, msg_id))
+    if row:
+        return [(row[0], 0, row[1], unpack_text(row[2]), row[3])]
+    return []
 
 def fetch(bcid, chat_id, msg_id):
+    # Правленые сообщения: последняя ревизия важнее исходной строки
+    rev = fetch_revision(bcid, chat_id, msg_id)
+    if rev:
+        log_debug("fetch.hit", via="revision")
+        return rev
+
     # Сначала ищем по точному совпадению bcid + chat_id + msg_id
-    row = db.execute(
-        "SELECT text, media_type, file_id FROM biz_messages WHERE bcid=? AND chat_id=? AND msg_id=?",
+    row = partition_first(
+        "SELECT text, media_type, file_id FROM {t} WHERE bcid=? AND chat_id=? AND msg_id=?",
         (bcid, chat_id, msg_id)
-    ).fetchone()
+    )
     if row:
-        d("[fetch hit bcid]")
-        return row
+        log_debug("fetch.hit", via="bcid")
+        return unpack_text(row[0]), row[1], row[2]
     
     # Затем ищем по chat_id + msg_id (без bcid)
-    row = db.execute(
-        "SELECT text, media_type, file_id FROM biz_messages WHERE chat_id=? AND msg_id=? ORDER BY date DESC LIMIT 1",
+    rev = fetch_revision(None, chat_id, msg_id)
+    if rev:
+        log_debug("fetch.hit", via="revision_generic")
+        return rev
+    row = partition_first(
+        "SELECT text, media_type, file_id FROM {t} WHERE chat_id=? AND msg_id=? ORDER BY date DESC LIMIT 1",
         (chat_id, msg_id)
-    ).fetchone()
+    )
     if row:
-        d("[fetch hit generic]")
-        return row
+        log_debug("fetch.hit", via="generic")
+        return unpack_text(row[0]), row[1], row[2]
     
     # Если не нашли, попробуем найти ближайшие сообщения в том же чате
     if bcid:
         # Для бизнес-сообщений ищем в диапазоне ±10 от указанного msg_id
-        row = db.execute(
-            "SELECT text, media_type, file_id FROM biz_messages WHERE bcid=? AND chat_id=? AND msg_id BETWEEN ? AND ? ORDER BY ABS(msg_id - ?) ASC LIMIT 1",
+        row = partition_first(
+            "SELECT bcid, msg_id, text, media_type, file_id FROM {t} WHERE bcid=? AND chat_id=? AND msg_id BETWEEN ? AND ? ORDER BY ABS(msg_id - ?) ASC LIMIT 1",
             (bcid, chat_id, msg_id - 10, msg_id + 10, msg_id)
-        ).fetchone()
+        )
         if row:
-            d("[fetch hit range bcid]", {"target": msg_id, "found": "nearby"})
-            return row
+            log_debug("fetch.hit", via="range_bcid", target=msg_id, found=row[1])
+            return fetch_revision(row[0], chat_id, row[1]) or (unpack_text(row[2]), row[3], row[4])
     
     # Ищем ближайшие сообщения без bcid
-    row = db.execute(
-        "SELECT text, media_type, file_id FROM biz_messages WHERE chat_id=? AND msg_id BETWEEN ? AND ? ORDER BY ABS(msg_id - ?) ASC LIMIT 1",
+    row = partition_first(
+        "SELECT bcid, msg_id, text, media_type, file_id FROM {t} WHERE chat_id=? AND msg_id BETWEEN ? AND ? ORDER BY ABS(msg_id - ?) ASC LIMIT 1",
         (chat_id, msg_id - 10, msg_id + 10, msg_id)
-    ).fetchone()
+    )
     if row:
-        d("[fetch hit range generic]", {"target": msg_id, "found": "nearby"})
-        return row
+        log_debug("fetch.hit", via="range_generic", target=msg_id, found=row[1])
+        return fetch_revision(row[0], chat_id, row[1]) or (unpack_text(row[2]), row[3], row[4])
     
-    d("[fetch miss]", {"bcid": bcid, "chat": chat_id, "msg": msg_id})
+    log_debug("fetch.miss", bcid=bcid, chat=chat_id, msg=msg_id)
     return None, None, None
 
+# ===== retention и обслуживание БД =====
+def parse_retention_rules(spec: str) -> dict:
+    """'chat:123=30,bcid:AbC=365' -> {("chat", 123): 30, ("bcid", "AbC"): 365}"""
+    rules = {}
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            key, days = item.rsplit("=", 1)
+            scope, ident = key.split(":", 1)
+            if scope == "chat":
+                ident = int(ident)
+            elif scope != "bcid":
+                raise ValueError(scope)
+            rules[(scope, ident)] = int(days)
+        except ValueError:
+            log_warning("retention.bad_rule", rule=item)
+    return rules
+
+_retention_rules = parse_retention_rules(RETENTION_RULES)
+_last_maintenance = 0.0
+
+def retention_horizon() -> int | None:
+    """Сколько дней гарантированно хранится любое сообщение; None — если что-то хранится бессрочно"""
+    days = [RETENTION_DAYS, *_retention_rules.values()]
+    return None if 0 in days else max(days)
+
+def retention_sweeps(now: int) -> list[tuple[str, list, int]]:
+    """Условия построчной очистки (условие, параметры, граница по date).
+    Правило чата важнее правила bcid, оба важнее RETENTION_DAYS."""
+    chats = [(k, v) for (scope, k), v in _retention_rules.items() if scope == "chat"]
+    bcids = [(k, v) for (scope, k), v in _retention_rules.items() if scope == "bcid"]
+    chat_ids = [k for k, _ in chats]
+    bcid_ids = [k for k, _ in bcids]
+    not_chats = f" AND chat_id NOT IN ({','.join('?' * len(chat_ids))})" if chat_ids else ""
+    not_bcids = f" AND bcid NOT IN ({','.join('?' * len(bcid_ids))})" if bcid_ids else ""
+    sweeps = []
+    for chat_id, days in chats:
+        if days:
+            cutoff = now - days * 86400
+            sweeps.append(("chat_id=? AND date<?", [chat_id, cutoff], cutoff))
+    for bcid, days in bcids:
+        if days:
+            cutoff = now - days * 86400
+            sweeps.append(("bcid=? AND date<?" + not_chats, [bcid, cutoff, *chat_ids], cutoff))
+    if RETENTION_DAYS:
+        cutoff = now - RETENTION_DAYS * 86400
+        sweeps.append(("date<?" + not_chats + not_bcids, [cutoff, *chat_ids, *bcid_ids], cutoff))
+    return sweeps
+
+def _partition_bounds(name: str) -> tuple[int, int] | None:
+    """[начало месяца, начало следующего) для biz_messages_ГГГГММ; None для старой biz_messages"""
+    if not name.startswith(PARTITION_PREFIX):
+        return None
+    ym = name[len(PARTITION_PREFIX):]
+    y, m = int(ym[:4]), int(ym[4:])
+    start = time.mktime((y, m, 1, 0, 0, 0, 0, 0, -1))
+    end   = time.mktime((y + m // 12, m % 12 + 1, 1, 0, 0, 0, 0, 0, -1))
+    return int(start), int(end)
+
+def drop_expired_partition(now: int) -> str | None:
+    """Удаляет одну самую старую партицию, целиком вышедшую за горизонт хранения"""
+    horizon = retention_horizon()
+    if horizon is None:
+        return None
+    for name in reversed(partitions()):
+        bounds = _partition_bounds(name)
+        if bounds and bounds[1] <= now - horizon * 86400:
+            db.execute(f"DROP TABLE IF EXISTS {name}")
+            load_partitions()
+            return name
+    return None
+
+def _sweep_batch(cond: str, args: list, cutoff: int, limit: int) -> int:
+    """Одна порция построчного удаления по условию во всех таблицах; возвращает число строк"""
+    removed = 0
+    for name in list(partitions()):
+        bounds = _partition_bounds(name)
+        if bounds and bounds[0] >= cutoff:
+            continue   # в партиции нет строк старше границы
+        removed += db.execute(
+            f"DELETE FROM {name} WHERE rowid IN (SELECT rowid FROM {name} WHERE {cond} LIMIT ?)", (*args, limit - removed)
+        ).rowcount
+        if removed >= limit:
+            return removed
+    removed += db.execute(
+        f"DELETE FROM biz_revisions WHERE (chat_id, msg_id, bcid, rev) IN "
+        f"(SELECT chat_id, msg_id, bcid, rev FROM biz_revisions WHERE {cond} LIMIT ?)", (*args, limit - removed)
+    ).rowcount
+    if removed >= limit:
+        return removed
+    ids = [(r[0],) for r in db.execute(f"SELECT id FROM biz_search_docs WHERE {cond} LIMIT ?", (*args, limit - removed))]
+    db.executemany("DELETE FROM biz_fts WHERE rowid=?", ids)
+    db.executemany("DELETE FROM biz_search_docs WHERE id=?", ids)
+    return removed + len(ids)
+
+def maintenance_tick(force: bool = False):
+    """Небольшая порция обслуживания между опросами: retention и incremental_vacuum"""
+    global _last_maintenance
+    now = time.time()
+    if not force and now - _last_maintenance < MAINTENANCE_INTERVAL:
+        return
+    _last_maintenance = now
+
+    dropped = drop_expired_partition(int(now))
+    budget  = RETENTION_BATCH
+    for cond, args, cutoff in retention_sweeps(int(now)):
+        budget -= _sweep_batch(cond, args, cutoff, budget)
+        if budget <= 0:
+            break
+    db.commit()
+    codec_tick(int(now))
+    if budget <= 0 or dropped:
+        _last_maintenance = now - MAINTENANCE_INTERVAL   # работа осталась — следующий шаг сразу
+
+    freed = 0
+    if incremental_vacuum_enabled() and db.execute("PRAGMA freelist_count").fetchone()[0]:
+        before = db.execute("PRAGMA page_count").fetchone()[0]
+        # через execute() sqlite3 делает один шаг прагмы (= одна страница), executescript доводит до конца
+        db.executescript(f"PRAGMA incremental_vacuum({VACUUM_STEP_PAGES});")
+        freed = before - db.execute("PRAGMA page_count").fetchone()[0]
+    if dropped or budget < RETENTION_BATCH or freed:
+        log_info("maintenance", dropped=dropped, removed=RETENTION_BATCH - budget, vacuum_pages=freed)
+
 def build_chat_name(chat: dict | None) -> str | None:
     if not chat:
         return None
@@ -232,15 +938,18 @@ def build_chat_name(chat: dict | None) -> str | None:
         return fullname or chat.get("username")
     return chat.get("title")
 
+def person_name(actor: dict | None) -> str | None:
+    if not actor:
+        return None
+    first = actor.get("first_name") or ""
+    last  = actor.get("last_name") or ""
+    fullname = (first + (" " + last if last else "")).strip()
+    return fullname or actor.get("username")
+
 def actor_link(actor: dict | None, fallback_user_id: int | None, fallback_name: str | None = None) -> str:
-    uid = None
-    name = None
-    if actor:
-        uid  = actor.get("id")
-        first = actor.get("first_name") or ""
-        last  = actor.get("last_name") or ""
-        fullname = (first + (" " + last if last else "")).strip()
-        name = fullname or actor.get("username")
+    return user_link((actor or {}).get("id"), person_name(actor), fallback_user_id, fallback_name)
+
+def user_link(uid, name, fallback_user_id: int | None, fallback_name: str | None = None) -> str:
     if not uid:
         uid = fallback_user_id
     if not name:
@@ -248,46 +957,214 @@ def actor_link(actor: dict | None, fallback_user_id: int | None, fallback_name:
     name = html_escape(name)
     return f'<a href="tg://user?id={uid}">{name}</a>' if uid else name
 
+# ===== разбор апдейтов =====
+# Апдейт разбирается один раз: вид апдейта, bcid и поля сообщения (текст, медиа, чат)
+# складываются в объекты со __slots__, и обработчики больше не ходят по dict заново.
+# Msg копирует только нужные скаляры — исходный dict сообщения после разбора не держится.
+MEDIA_KINDS = ("photo", "video", "document", "voice", "audio", "animation", "video_note")
+_MEDIA_RANK = {k: i for i, k in enumerate(MEDIA_KINDS)}   # у GIF есть и animation, и document — берём document
+
+class Msg:
+    __slots__ = ("id", "date", "chat_id", "chat_name", "sender_id", "sender_name", "text",
+                 "media_type", "file_id", "file_size", "duration", "mime_type", "file_name", "reply_to")
+
+    def __init__(self, m: dict):
+        chat   = m.get("chat")
+        sender = m.get("from")
+        self.id          = m.get("message_id")
+        self.date        = m.get("date")
+        self.chat_id     = chat.get("id") if chat else None
+        self.chat_name   = build_chat_name(chat)
+        self.sender_id   = sender.get("id") if sender else None
+        self.sender_name = person_name(sender)
+        self.text        = (m.get("text") or m.get("caption") or "").strip()
+        reply            = m.get("reply_to_message")
+        self.reply_to    = Msg(reply) if reply else None
+        self.media_type = self.file_id = self.file_size = self.duration = self.mime_type = self.file_name = None
+        kind = None
+        for k in m:   # один проход по ключам сообщения вместо проверки каждого типа медиа
+            r = _MEDIA_RANK.get(k)
+            if r is not None and (kind is None or r < _MEDIA_RANK[kind]):
+                kind = k
+        if kind is None:
+            return
+        media = m[kind]
+        if kind == "photo":
+            if not (isinstance(media, list) and media):
+                return
+            media = max(media, key=lambda x: x.get("file_size", 0))
+        self.media_type = kind
+        self.file_id    = media.get("file_id")
+        self.file_size  = media.get("file_size")
+        self.duration   = media.get("duration")
+        self.mime_type  = media.get("mime_type")
+        self.file_name  = media.get("file_name")
+
+class Update:
+    # body — тело апдейта без сообщения (callback, удаления, подключение); для сообщений None
+    __slots__ = ("id", "kind", "body", "bcid", "nested", "message")
+
+    def __init__(self, update_id, kind: str, body: dict | None, bcid, nested: bool, message: Msg | None):
+        self.id      = update_id
+        self.kind    = kind
+        self.body    = body
+        self.bcid    = bcid
+        self.nested  = nested    # бизнес-сообщение пришло обёрткой с полем "message"
+        self.message = message
+
+# виды апдейтов, где тело — само сообщение или обёртка с ним в поле "message"
+_MESSAGE_KINDS = {"message", "edited_message", "business_message", "edited_business_message"}
+
+def decode_update(raw: dict) -> Update | None:
+    kind = next((k for k in raw if k in UPDATE_HANDLERS), None)
+    if kind is None:
+        return None
+    body = raw[kind] or {}
+    bcid = body.get("business_connection_id")
+    if kind not in _MESSAGE_KINDS:
+        return Update(raw.get("update_id"), kind, body, bcid, False, None)
+    if kind == "business_message" and LOG_DEBUG_ON:
+        # детальная структура; сериализуется только если событие прошло уровень и сэмплинг
+        log(LOG_DEBUG, "business_message.raw", has_bcid=bool(bcid), has_msg="message" in body, raw_bmsg=body)
+    nested = "message" in body
+    return Update(raw.get("update_id"), kind, None, bcid, nested, Msg(body["message"] if nested else body))
+
+def bench_decode(path: str = RAW_UPDATES, rounds: int = 20):
+    """Замер разбора записанных апдейтов: CPU и память на апдейт (json vs orjson, dict vs Msg)"""
+    import tracemalloc
+    lines = []
+    with open(path, "rb") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                try:
+                    json.loads(line); lines.append(line)
+                except ValueError:
+                    pass
+    if not lines:
+        print("bench-decode: нет апдейтов в", path)
+        return
+    print(f"апдейтов: {len(lines)}, средний размер: {sum(map(len, lines)) / len(lines):.0f} байт, orjson: {'да' if orjson else 'нет'}")
+    loaders = [("json", json.loads)] + ([("orjson", orjson.loads)] if orjson else [])
+    print(f"{'этап':<22}{'CPU, мкс/апд':>14}{'память, байт/апд':>18}")
+    for name, loads in loaders:
+        for stage, work in ((f"{name}: разбор", lambda l: loads(l)),
+                            (f"{name}: + decode", lambda l: decode_update(loads(l)))):
+            t = time.process_time()
+            for _ in range(rounds):
+                for l in lines:
+                    work(l)
+            cpu = (time.process_time() - t) / (rounds * len(lines)) * 1e6
+            tracemalloc.start()
+            kept = [work(l) for l in lines]
+            mem = tracemalloc.get_traced_memory()[0] / len(lines)
+            tracemalloc.stop()
+            del kept
+            print(f"{stage:<22}{cpu:>14.1f}{mem:>18.0f}")
+
 # ===== media cache helpers =====
 def _cache_dir_for_chat(chat_id: int) -> str:
     p = os.path.join(MEDIA_CACHE_DIR, str(chat_id))
     os.makedirs(p, exist_ok=True)
     return p
 
-def _cache_meta_path(chat_id: int, msg_id: int) -> str:
-    return os.path.join(_cache_dir_for_chat(chat_id), f"{msg_id}.json")
-
 def _cache_file_path(chat_id: int, msg_id: int, src_filename: str) -> str:
     base, ext = os.path.splitext(src_filename)
     if not ext:
         ext = ".bin"
     return os.path.join(_cache_dir_for_chat(chat_id), f"{msg_id}{ext}")
 
-def cache_media_from_message(chat_id: int, msg: dict):
-    mtype, fid = parse_media(msg)
+def cache_media_from_message(m: Msg):
+    chat_id, mtype, fid = m.chat_id, m.media_type, m.file_id
     if not (mtype and fid):
         return
     try:
         url, fname = get_file_path(fid)
         tmp = download_file(url, fname)
-        dst = _cache_file_path(chat_id, msg.get("message_id") or 0, fname)
-        shutil.copyfile(tmp, dst)
-        meta = {"media_type": mtype, "file": os.path.basename(dst), "ts": int(time.time())}
-        with open(_cache_meta_path(chat_id, msg.get("message_id") or 0), "w", encoding="utf-8") as f:
-            json.dump(meta, f, ensure_ascii=False)
-        d("[cache saved]", {"chat": chat_id, "msg": msg.get("message_id"), "mtype": mtype, "file": dst})
+        msg_id = m.id or 0
+        dst = _cache_file_path(chat_id, msg_id, fname)
+        # запись через временный файл + os.replace: читатель видит либо старый, либо целый новый файл;
+        # строка в индексе появляется только после того, как файл на месте
+        shutil.copyfile(tmp, dst + ".part")
+        size = os.path.getsize(dst + ".part")
+        os.replace(dst + ".part", dst)
+        index_cached_media(chat_id, msg_id, mtype, os.path.basename(dst), size)
+        log_debug("cache.saved", chat=chat_id, msg=msg_id, mtype=mtype, file=dst)
     except Exception as e:
-        d("[cache error]", str(e))
+        log_warning("cache.error", chat=chat_id, error=repr(e))
+
+def index_cached_media(chat_id: int, msg_id: int, media_type: str, fname: str, size: int, ts: int | None = None):
+    db.execute(
+        "INSERT OR REPLACE INTO media_index(chat_id,msg_id,media_type,file,size,ts) VALUES(?,?,?,?,?,?)",
+        (chat_id, msg_id, media_type, fname, size, ts or int(time.time()))
+    )
+    db.commit()
+
+def lookup_cached_media(chat_id: int, msg_id: int):
+    """(media_type, путь) из индекса или None — без обращений к файловой системе"""
+    row = db.execute("SELECT media_type, file FROM media_index WHERE chat_id=? AND msg_id=?", (chat_id, msg_id)).fetchone()
+    if not row:
+        return None
+    return row[0], os.path.join(MEDIA_CACHE_DIR, str(chat_id), row[1])
+
+def forget_cached_media(chat_id: int, msg_id: int):
+    db.execute("DELETE FROM media_index WHERE chat_id=? AND msg_id=?", (chat_id, msg_id))
+    db.commit()
+
+# тип по расширению — для файлов без (или с пустым) старым .json
+MEDIA_TYPE_BY_EXT = {
+    ".jpg": "photo", ".jpeg": "photo", ".png": "photo", ".webp": "photo",
+    ".mp4": "video", ".mov": "video", ".mkv": "video", ".webm": "video", ".m4v": "video",
+    ".oga": "voice", ".ogg": "voice", ".opus": "voice",
+    ".mp3": "audio", ".m4a": "audio", ".flac": "audio", ".wav": "audio",
+    ".gif": "animation",
+}
+
+def _legacy_sidecar_type(path: str) -> str | None:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f).get("media_type")
+    except (OSError, ValueError, AttributeError):
+        return None   # нет файла или он пустой/битый
+
+def rebuild_media_index() -> int:
+    """Заново строит media_index по файлам в media_cache/<chat_id>/<msg_id>.<ext>"""
+    rows = []
+    for chat_dir in os.scandir(MEDIA_CACHE_DIR) if os.path.isdir(MEDIA_CACHE_DIR) else []:
+        if not chat_dir.is_dir():
+            continue
+        try:
+            chat_id = int(chat_dir.name)
+        except ValueError:
+            continue
+        for entry in os.scandir(chat_dir.path):
+            stem, ext = os.path.splitext(entry.name)
+            if ext in (".json", ".part") or stem.endswith("_muted") or not entry.is_file():
+                continue
+            try:
+                msg_id = int(stem)
+            except ValueError:
+                continue
+            st = entry.stat()
+            mtype = (_legacy_sidecar_type(os.path.join(chat_dir.path, stem + ".json"))
+                     or MEDIA_TYPE_BY_EXT.get(ext.lower(), "document"))
+            rows.append((chat_id, msg_id, mtype, entry.name, st.st_size, int(st.st_mtime)))
+    with db:
+        db.execute("DELETE FROM media_index")
+        db.executemany("INSERT OR REPLACE INTO media_index(chat_id,msg_id,media_type,file,size,ts) VALUES(?,?,?,?,?,?)", rows)
+    log_info("media_index.rebuilt", files=len(rows))
+    return len(rows)
 
 # ===== ffmpeg helpers =====
 def run_ffmpeg(args: list) -> None:
-    d("[ffmpeg]", {"args": args})
+    log_debug("ffmpeg", args=args)
     p = subprocess.run(["ffmpeg", "-y"] + args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
     if p.returncode != 0:
         raise RuntimeError("ffmpeg failed: " + (p.stdout or ""))
 
 def make_video_note_square(src_path: str) -> str:
-    dst = os.path.join(os.path.dirname(src_path), "circle_640.mp4")
+    # отдельный каталог на каждый вызов: один и тот же исходник могут кодировать две задачи сразу
+    dst = os.path.join(tempfile.mkdtemp(prefix="dlb_out_"), "circle_640.mp4")
     vf = "scale='if(gt(iw,ih),-2,640)':'if(gt(iw,ih),640,-2)',crop=640:640"
     run_ffmpeg([
         "-i", src_path,
@@ -318,21 +1195,18 @@ def make_muted_copy(src_path: str) -> str:
     return dst
 
 def extract_voice_ogg(src_path: str) -> str:
-    dst = os.path.join(os.path.dirname(src_path), "voice.ogg")
+    dst = os.path.join(tempfile.mkdtemp(prefix="dlb_out_"), "voice.ogg")
     run_ffmpeg(["-i", src_path, "-vn", "-c:a", "libopus", "-b:a", "64k", "-ar", "48000", "-ac", "1", dst])
     return dst
 
-def ensure_local_video_from_message(m: dict) -> str | None:
-    if "video" in m:
-        url, fname = get_file_path(m["video"]["file_id"])
+def ensure_local_video_from_message(m: Msg) -> str | None:
+    if m.media_type in ("video", "animation"):
+        url, fname = get_file_path(m.file_id)
         return download_file(url, fname)
-    if "animation" in m:
-        url, fname = get_file_path(m["animation"]["file_id"])
-        return download_file(url, fname)
-    if "document" in m:
-        mime = (m["document"].get("mime_type") or "")
-        if mime.startswith("video/") or m["document"].get("file_name","").lower().endswith((".mp4",".mov",".mkv",".webm",".m4v")):
-            url, fname = get_file_path(m["document"]["file_id"])
+    if m.media_type == "document":
+        mime = (m.mime_type or "")
+        if mime.startswith("video/") or (m.file_name or "").lower().endswith((".mp4",".mov",".mkv",".webm",".m4v")):
+            url, fname = get_file_path(m.file_id)
             return download_file(url, fname)
     return None
 
@@ -343,7 +1217,21 @@ def find_urls(text: str) -> list[str]:
     rx = r'(https?://\S+)'
     return re.findall(rx, text)
 
+class MediaRejected(Exception):
+    """Ссылка отклонена по лимитам MEDIA_*; текст исключения — ответ пользователю"""
+
+def _ytdl_reject(info: dict, *, incomplete: bool = False) -> str | None:
+    """match_filter для yt-dlp: слишком длинное или тяжёлое отсекается по метаданным, до скачивания"""
+    if (info.get("duration") or 0) > MEDIA_MAX_DURATION:
+        return f"Медиа длиннее {MEDIA_MAX_DURATION} с, не возьмусь."
+    size = info.get("filesize") or info.get("filesize_approx") or sum(
+        f.get("filesize") or f.get("filesize_approx") or 0 for f in info.get("requested_formats") or ())
+    if size > MEDIA_MAX_MB * 1024 * 1024:
+        return f"Файл больше {MEDIA_MAX_MB} МБ, не возьмусь."
+    return None
+
 def download_video_from_url(url: str) -> str | None:
+    """Путь к скачанному mp4; None — не получилось; MediaRejected — ссылка не проходит по лимитам"""
     tmp = tempfile.mkdtemp(prefix="dlb_url_")
     outtmpl = os.path.join(tmp, "video.%(ext)s")
     ydl_opts = {
@@ -355,7 +1243,10 @@ def download_video_from_url(url: str) -> str | None:
         "no_warnings": True,
         "retries": 3,
         "geo_bypass": True,
+        "max_filesize": MEDIA_MAX_MB * 1024 * 1024,
+        "match_filter": _ytdl_reject,
     }
+    reason = None
     try:
         with YoutubeDL(ydl_opts) as ydl:
             info = ydl.extract_info(url, download=True)
@@ -367,8 +1258,14 @@ def download_video_from_url(url: str) -> str | None:
                     filepath = merged
             if os.path.exists(filepath):
                 return filepath
+            # match_filter и max_filesize не бросают исключение, а молча пропускают скачивание:
+            # причину восстанавливаем по тем же метаданным
+            reason = _ytdl_reject(info)
     except Exception as e:
-        d("[yt-dlp error]", str(e))
+        log_warning("yt_dlp.error", url=url, error=str(e))
+    if reason:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise MediaRejected(reason)
     return None
 
 # ===== UI helpers (inline keyboard) =====
@@ -393,7 +1290,7 @@ def get_file_path(file_id: str) -> tuple[str, str]:
 def download_file(url: str, fname: str) -> str:
     tmp = tempfile.mkdtemp(prefix="dlb_")
     local = os.path.join(tmp, fname)
-    d("[download]", {"url": url, "to": local})
+    log_debug("download", to=local)
     with requests.get(url, stream=True, timeout=600) as r:
         r.raise_for_status()
         with open(local, "wb") as f:
@@ -423,7 +1320,7 @@ def send_cached_file_to_log(media_type: str, local_path: str, caption_html: str)
         else:
             tg_upload("sendDocument", "document", local_path, chat_id=target_chat, caption=caption_html, parse_mode="HTML")
     except Exception as e:
-        print("send_cached_file_to_log error:", e)
+        log_error("send_cached_file_to_log.error", media_type=media_type, error=repr(e))
         send_log_html(caption_html)
 
 def send_media_to_log(media_type: str, file_id: str, caption_html: str):
@@ -440,25 +1337,28 @@ def send_media_to_log(media_type: str, file_id: str, caption_html: str):
         else:
             tg_call("sendDocument", chat_id=target_chat, document=file_id, caption=caption_html, parse_mode="HTML")
     except Exception as e:
-        print("send_media_to_log error:", e)
+        log_error("send_media_to_log.error", media_type=media_type, error=repr(e))
         send_log_html(caption_html)
 
 def try_send_from_cache(chat_id: int, msg_id: int, caption_html: str) -> bool:
-    meta_path = _cache_meta_path(chat_id, msg_id)
-    if not os.path.exists(meta_path):
+    hit = lookup_cached_media(chat_id, msg_id)
+    if not hit:
         return False
+    media_type, local_path = hit
     try:
-        with open(meta_path, "r", encoding="utf-8") as f:
-            meta = json.load(f)
-        media_type = meta.get("media_type")
-        fname      = meta.get("file")
-        local_path = os.path.join(_cache_dir_for_chat(chat_id), fname) if fname else None
-        if media_type and local_path and os.path.exists(local_path):
-            send_cached_file_to_log(media_type, local_path, caption_html)
-            d("[cache hit -> sent]", {"chat": chat_id, "msg": msg_id, "mtype": media_type, "file": local_path})
-            return True
+        # файл мог удалить кто-то снаружи — тогда запись в индексе устарела
+        with open(local_path, "rb"):
+            pass
+    except FileNotFoundError:
+        forget_cached_media(chat_id, msg_id)
+        log_warning("cache.stale_index", chat=chat_id, msg=msg_id, file=local_path)
+        return False
+    try:
+        send_cached_file_to_log(media_type, local_path, caption_html)
+        log_debug("cache.hit_sent", chat=chat_id, msg=msg_id, mtype=media_type, file=local_path)
+        return True
     except Exception as e:
-        d("[cache send error]", str(e))
+        log_error("cache.send_error", chat=chat_id, msg=msg_id, error=repr(e))
     return False
 
 def cleanup_cache(days: int = CACHE_TTL_DAYS):
@@ -467,36 +1367,383 @@ def cleanup_cache(days: int = CACHE_TTL_DAYS):
     root = MEDIA_CACHE_DIR
     if not os.path.isdir(root):
         return
+    if not db.execute("SELECT 1 FROM media_index LIMIT 1").fetchone():
+        rebuild_media_index()   # первый запуск после перехода с .json-файлов
     removed = 0
+    expired = db.execute("SELECT chat_id, msg_id, file FROM media_index WHERE ts < ?", (int(now - ttl),)).fetchall()
+    for chat_id, msg_id, fname in expired:
+        base = os.path.join(root, str(chat_id), fname)
+        for p in (base, os.path.splitext(base)[0] + "_muted.mp4"):
+            try:
+                os.remove(p); removed += 1
+            except FileNotFoundError:
+                pass
+    with db:
+        db.executemany("DELETE FROM media_index WHERE chat_id=? AND msg_id=?", [(c, m) for c, m, _ in expired])
+    # остальное, чего нет в индексе (старые .json, недописанные .part), — по mtime
+    indexed = {(str(c), f) for c, f in db.execute("SELECT chat_id, file FROM media_index").fetchall()}
     for dirpath, _, files in os.walk(root):
+        chat = os.path.basename(dirpath)
         for name in files:
+            if (chat, name) in indexed:
+                continue
             p = os.path.join(dirpath, name)
             try:
                 if now - os.path.getmtime(p) > ttl:
                     os.remove(p); removed += 1
             except Exception:
                 pass
-    d("[cache cleanup]", {"removed": removed})
+    log_info("cache.cleanup", removed=removed, indexed_expired=len(expired))
 
-# ===== callbacks =====
-def handle_callback_query(u):
-    cq = u.get("callback_query") or {}
-    data = cq.get("data") or ""
-    msg  = cq.get("message") or {}
+# ===== поиск (/search) =====
+SEARCH_TYPES = ("photo", "video", "document", "voice", "audio", "animation", "video_note", "text")
+SEARCH_USAGE = (
+    "Использование: /search [chat:ID] [from:ГГГГ-ММ-ДД] [to:ГГГГ-ММ-ДД] [type:ТИП] слова\n"
+    "Типы: " + ", ".join(SEARCH_TYPES) + ". Слово со * на конце ищется по префиксу."
+)
+
+def is_owner(user_id) -> bool:
+    owner = get_owner_id()
+    return bool(owner) and str(user_id) == owner
+
+def _parse_day(s: str) -> int:
     try:
-        kind, src_chat, src_msg = data.split(":", 2)
-        src_chat = int(src_chat); src_msg = int(src_msg)
-    except Exception:
-        tg_call("answerCallbackQuery", callback_query_id=cq.get("id"), text="Некорректные данные.", show_alert=True)
+        return int(time.mktime(time.strptime(s, "%Y-%m-%d")))
+    except ValueError:
+        raise ValueError(f"некорректная дата: {s}")
+
+def parse_search_args(text: str) -> dict:
+    params = {"query": "", "chat_id": None, "date_from": None, "date_to": None, "media_type": None}
+    words = []
+    for tok in text.split()[1:]:
+        key, sep, val = tok.partition(":")
+        if not (sep and val and key in ("chat", "from", "to", "type")):
+            words.append(tok)
+            continue
+        if key == "chat":
+            try:
+                params["chat_id"] = int(val)
+            except ValueError:
+                raise ValueError(f"некорректный chat: {val}")
+        elif key == "from":
+            params["date_from"] = _parse_day(val)
+        elif key == "to":
+            params["date_to"] = _parse_day(val) + 86399
+        else:
+            if val not in SEARCH_TYPES:
+                raise ValueError(f"неизвестный тип: {val}")
+            params["media_type"] = val
+    params["query"] = " ".join(words)
+    return params
+
+def fts_query(q: str) -> str:
+    """Превращает пользовательский ввод в безопасное выражение FTS5 MATCH"""
+    terms = []
+    for t in (q or "").split():
+        prefix = t.endswith("*")
+        t = t.rstrip("*").replace('"', '""')
+        if t:
+            terms.append(f'"{t}"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+def search_messages(query, chat_id=None, date_from=None, date_to=None, media_type=None, page=0, limit=SEARCH_PAGE_SIZE):
+    # новые сообщения первыми: FTS5 отдаёт rowid по убыванию без сортировки всех совпадений
+    where, args = [], []
+    if chat_id is not None:
+        where.append("s.chat_id=?"); args.append(chat_id)
+    if date_from is not None:
+        where.append("s.date>=?"); args.append(date_from)
+    if date_to is not None:
+        where.append("s.date<=?"); args.append(date_to)
+    if media_type == "text":
+        where.append("s.media_type IS NULL")
+    elif media_type:
+        where.append("s.media_type=?"); args.append(media_type)
+
+    match = fts_query(query)
+    if match:
+        sql = (
+            "SELECT s.bcid, s.chat_id, s.msg_id, s.date, s.media_type, "
+            "snippet(biz_fts, 0, char(2), char(3), '…', 16) "
+            "FROM biz_fts JOIN biz_search_docs s ON s.id = biz_fts.rowid "
+            "WHERE biz_fts MATCH ?" + "".join(" AND " + w for w in where) +
+            " ORDER BY biz_fts.rowid DESC LIMIT ? OFFSET ?"
+        )
+        args = [match] + args
+    else:
+        sql = (
+            "SELECT s.bcid, s.chat_id, s.msg_id, s.date, s.media_type, substr(f.text, 1, 120) "
+            # CROSS JOIN фиксирует порядок (сначала документы), а сортировка по (date, id) идёт
+            # прямо по индексу (chat_id, date) или (date) — без временного B-дерева на весь чат
+            "FROM biz_search_docs s CROSS JOIN biz_fts f ON f.rowid = s.id" +
+            (" WHERE " + " AND ".join(where) if where else "") +
+            " ORDER BY s.date DESC, s.id DESC LIMIT ? OFFSET ?"
+        )
+    return db.execute(sql, (*args, limit, page * SEARCH_PAGE_SIZE)).fetchall()
+
+def render_search_page(search_id: int, page: int):
+    row = db.execute(
+        "SELECT query, chat_id, date_from, date_to, media_type FROM biz_searches WHERE id=?", (search_id,)
+    ).fetchone()
+    if not row:
+        return None, None
+    # берём на одну строку больше, чтобы понять, есть ли следующая страница
+    results = search_messages(*row, page=page, limit=SEARCH_PAGE_SIZE + 1)
+    has_more = len(results) > SEARCH_PAGE_SIZE
+    lines = [f"🔎 <b>Поиск:</b> <code>{html_escape(row[0] or '*')}</code> — стр. {page + 1}"]
+    if not results:
+        lines.append("\nНичего не найдено.")
+    for bcid, chat_id, msg_id, date, mtype, snip in results[:SEARCH_PAGE_SIZE]:
+        when = time.strftime("%Y-%m-%d %H:%M", time.localtime(date or 0))
+        snip_html = html_escape(snip or "").replace("\x02", "<b>").replace("\x03", "</b>") or "(без текста)"
+        lines.append(
+            f"\n<b>{when}</b> · чат <code>{chat_id}</code> · id <code>{msg_id}</code>"
+            + (f" · {mtype}" if mtype else "")
+            + f"\n{snip_html}"
+        )
+    nav = []
+    if page > 0:
+        nav.append({"text": "◀️", "callback_data": f"s:{search_id}:{page - 1}"})
+    if has_more:
+        nav.append({"text": "▶️", "callback_data": f"s:{search_id}:{page + 1}"})
+    return "\n".join(lines), ({"inline_keyboard": [nav]} if nav else None)
+
+def handle_search_command(m: Msg):
+    chat_id = m.chat_id
+    msg_id  = m.id
+    if not is_owner(m.sender_id):
+        tg_call("sendMessage", chat_id=chat_id, reply_to_message_id=msg_id, text="❌ Поиск доступен только владельцу бота.")
+        return
+    try:
+        p = parse_search_args(m.text)
+    except ValueError as e:
+        tg_call("sendMessage", chat_id=chat_id, reply_to_message_id=msg_id, text=f"Ошибка: {e}\n\n{SEARCH_USAGE}")
+        return
+    if not (fts_query(p["query"]) or p["chat_id"] is not None or p["date_from"] or p["date_to"] or p["media_type"]):
+        tg_call("sendMessage", chat_id=chat_id, reply_to_message_id=msg_id, text=SEARCH_USAGE)
         return
 
-    text, mtype, fid = fetch("", src_chat, src_msg)
-    if not fid or (mtype not in ("video", "animation", "document")):
-        tg_call("answerCallbackQuery", callback_query_id=cq.get("id"), text="Медиа не найдено или неподдерживаемо.", show_alert=True)
+    now = int(time.time())
+    search_id = db.execute(
+        "INSERT INTO biz_searches(query,chat_id,date_from,date_to,media_type,created) VALUES(?,?,?,?,?,?)",
+        (p["query"], p["chat_id"], p["date_from"], p["date_to"], p["media_type"], now)
+    ).lastrowid
+    db.execute("DELETE FROM biz_searches WHERE created < ?", (now - 86400,))
+    db.commit()
+
+    html, kb = render_search_page(search_id, 0)
+    params = {"chat_id": chat_id, "text": html, "parse_mode": "HTML", "disable_web_page_preview": True}
+    if kb:
+        params["reply_markup"] = json.dumps(kb)
+    tg_call("sendMessage", **params)
+    log_info("search", id=search_id, query=p["query"])
+
+def handle_search_callback(cq: dict, search_id: int, page: int):
+    msg = cq.get("message") or {}
+    if not is_owner((cq.get("from") or {}).get("id")):
+        tg_call("answerCallbackQuery", callback_query_id=cq.get("id"), text="Только для владельца.", show_alert=True)
+        return
+    html, kb = render_search_page(search_id, max(page, 0))
+    if html is None:
+        tg_call("answerCallbackQuery", callback_query_id=cq.get("id"), text="Поиск устарел, повтори /search.", show_alert=True)
+        return
+    tg_call("answerCallbackQuery", callback_query_id=cq.get("id"))
+    params = {"chat_id": (msg.get("chat") or {}).get("id"), "message_id": msg.get("message_id"),
+              "text": html, "parse_mode": "HTML", "disable_web_page_preview": True}
+    if kb:
+        params["reply_markup"] = json.dumps(kb)
+    tg_call("editMessageText", **params)
+
+# ===== история правок (/history) =====
+HISTORY_USAGE = "Использование: /history CHAT_ID MSG_ID (ID видны в результатах /search)"
+HISTORY_MAX_REVS = 10
+
+def render_history(chat_id: int, msg_id: int) -> str:
+    revs = fetch_history(chat_id, msg_id)
+    if not revs:
+        return f"Сообщение <code>{chat_id}</code>/<code>{msg_id}</code> не найдено."
+    lines = [f"🕓 <b>История сообщения</b> <code>{chat_id}</code>/<code>{msg_id}</code> — версий: {len(revs)}"]
+    if len(revs) > HISTORY_MAX_REVS:
+        lines.append(f"<i>(показаны последние {HISTORY_MAX_REVS})</i>")
+    for bcid, rev, date, text, mtype in revs[-HISTORY_MAX_REVS:]:
+        when  = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(date or 0))
+        label = "исходная" if rev == 0 else f"правка {rev}"
+        body  = html_escape(text[:300] + ("…" if len(text) > 300 else "")) or "(без текста)"
+        lines.append(f"\n<b>{label}</b> · {when}" + (f" · {mtype}" if mtype else "") + f"\n<code>{body}</code>")
+    return "\n".join(lines)
+
+def handle_history_command(m: Msg):
+    chat_id = m.chat_id
+    msg_id  = m.id
+    if not is_owner(m.sender_id):
+        tg_call("sendMessage", chat_id=chat_id, reply_to_message_id=msg_id, text="❌ История доступна только владельцу бота.")
+        return
+    try:
+        _, target_chat, target_msg = m.text.split()[:3]
+        target_chat = int(target_chat); target_msg = int(target_msg)
+    except ValueError:
+        tg_call("sendMessage", chat_id=chat_id, reply_to_message_id=msg_id, text=HISTORY_USAGE)
         return
+    tg_call("sendMessage", chat_id=chat_id, text=render_history(target_chat, target_msg),
+            parse_mode="HTML", disable_web_page_preview=True)
+
+# ===== тяжёлые медиа-задачи (yt-dlp, ffmpeg) =====
+# Скачивание и перекодирование идут в небольшом пуле потоков, а не в обработчике апдейтов:
+# очередь апдейтов не встаёт за одним длинным x264. Перед постановкой задачи проверяются лимиты
+# на пользователя, чат и общий размер очереди; при перегрузе задача не ставится, а пользователь
+# получает «попробуй позже». Задача, не начатая до дедлайна, отбрасывается.
+# Потоки пула не пишут в БД: общее соединение db используется потоком обработки апдейтов,
+# и чужой COMMIT зафиксировал бы его незаконченную транзакцию. Результат, который нужно
+# сохранить, уходит в очередь _media_done и применяется в drain_inbox().
+# Гарантия доставки у задач слабее, чем у апдейтов: строка inbox удаляется, как только задача
+# поставлена, поэтому падение или перезапуск процесса теряет задачи в очереди и в работе
+# (at-most-once). Держать строку до конца задачи значило бы остановить весь чат за ней:
+# апдейты чата обрабатываются строго по порядку.
+BUSY_TEXT = "⏳ Сейчас слишком много задач, попробуй позже."
+
+_media_pool: ThreadPoolExecutor | None = None
+_media_lock = threading.Lock()
+_media_total = 0
+_media_by_user: dict = {}
+_media_by_chat: dict = {}
+_media_done: queue.Queue = queue.Queue()
+_media_wake = None   # будит цикл обработки, когда задача вернула результат
+
+def media_result(fn, *args):
+    """Из потока пула: выполнить fn(*args) в потоке обработки апдейтов"""
+    _media_done.put((fn, args))
+    if _media_wake is not None:
+        _media_wake()
+
+def apply_media_results():
+    while True:
+        try:
+            fn, args = _media_done.get_nowait()
+        except queue.Empty:
+            return
+        try:
+            fn(*args)
+        except Exception as e:
+            log_error("media.result_error", error=repr(e))
+
+def media_too_big(m: Msg) -> str | None:
+    """Причина отказа по file_size/duration из апдейта — до того, как что-то скачано"""
+    if m.file_size and m.file_size > MEDIA_MAX_MB * 1024 * 1024:
+        return f"Файл больше {MEDIA_MAX_MB} МБ, не возьмусь."
+    if m.duration and m.duration > MEDIA_MAX_DURATION:
+        return f"Медиа длиннее {MEDIA_MAX_DURATION} с, не возьмусь."
+    return None
 
-    tg_call("answerCallbackQuery", callback_query_id=cq.get("id"), text="Готовлю…")
+def submit_media_job(user_id, chat_id: int, reply_to: int | None, deadline: float, job, *args) -> bool:
+    """Ставит задачу в пул, если есть место; False — задача отброшена (перегруз).
+    reply_to=None — задачу никто явно не просил, и о её отмене по дедлайну не сообщаем."""
+    global _media_pool, _media_total
+    with _media_lock:
+        if (_media_total >= MEDIA_QUEUE_MAX
+                or _media_by_user.get(user_id, 0) >= MEDIA_JOBS_PER_USER
+                or _media_by_chat.get(chat_id, 0) >= MEDIA_JOBS_PER_CHAT):
+            log_warning("media.shed", user=user_id, chat=chat_id, total=_media_total)
+            return False
+        _media_total += 1
+        _media_by_user[user_id] = _media_by_user.get(user_id, 0) + 1
+        _media_by_chat[chat_id] = _media_by_chat.get(chat_id, 0) + 1
+        if _media_pool is None:   # создаётся лениво: пул нужен только обработчику, который импортирует модуль заново (spawn)
+            _media_pool = ThreadPoolExecutor(MEDIA_WORKERS, thread_name_prefix="media")
+    _media_pool.submit(_run_media_job, user_id, chat_id, reply_to, deadline, job, args)
+    return True
+
+def _run_media_job(user_id, chat_id: int, reply_to: int | None, deadline: float, job, args):
+    global _media_total
+    try:
+        if time.time() > deadline:
+            log_warning("media.expired", user=user_id, chat=chat_id, late=int(time.time() - deadline))
+            if reply_to is not None:
+                tg_call("sendMessage", chat_id=chat_id, reply_to_message_id=reply_to, text=BUSY_TEXT)
+        else:
+            job(*args)
+    except Exception as e:
+        log_error("media.job_error", chat=chat_id, error=repr(e))
+    finally:
+        with _media_lock:
+            _media_total -= 1
+            for counts, key in ((_media_by_user, user_id), (_media_by_chat, chat_id)):
+                counts[key] -= 1
+                if not counts[key]:
+                    del counts[key]
+
+def start_media_command(m: Msg, job):
+    """/circle и /voice: проверка размера, дедлайна и лимитов, затем job(m, target) в пуле"""
+    target = m.reply_to or m
+    reason = media_too_big(target)
+    if reason:
+        tg_call("sendMessage", chat_id=m.chat_id, reply_to_message_id=m.id, text=reason)
+        return
+    deadline = (m.date or time.time()) + MEDIA_DEADLINE_SEC
+    if time.time() > deadline:
+        # команда пролежала в очереди дольше дедлайна — результат уже никому не нужен
+        log_warning("media.expired", user=m.sender_id, chat=m.chat_id, late=int(time.time() - deadline))
+        tg_call("sendMessage", chat_id=m.chat_id, reply_to_message_id=m.id, text=BUSY_TEXT)
+        return
+    if not submit_media_job(m.sender_id, m.chat_id, m.id, deadline, job, m, target):
+        tg_call("sendMessage", chat_id=m.chat_id, reply_to_message_id=m.id, text=BUSY_TEXT)
+
+def circle_job(m: Msg, target: Msg):
+    try:
+        src = ensure_local_video_from_message(target)
+        if not src:
+            urls = find_urls(target.text)
+            if urls:
+                src = download_video_from_url(urls[0])
+        if not src:
+            tg_call("sendMessage", chat_id=m.chat_id, reply_to_message_id=m.id,
+                    text="Прикрепи или ответь на видео/анимацию/документ с видео (или пришли ссылку).")
+            return
+        out = make_video_note_square(src)
+        tg_upload("sendVideoNote", "video_note", out, chat_id=m.chat_id, reply_to_message_id=m.id, length=640)
+    except MediaRejected as e:
+        tg_call("sendMessage", chat_id=m.chat_id, reply_to_message_id=m.id, text=str(e))
+    except Exception as e:
+        tg_call("sendMessage", chat_id=m.chat_id, reply_to_message_id=m.id, text=f"Ошибка circle: {e}")
+
+def voice_job(m: Msg, target: Msg):
+    try:
+        src = ensure_local_video_from_message(target)
+        if not src and target.media_type in ("audio", "voice"):
+            url, fname = get_file_path(target.file_id); src = download_file(url, fname)
+        if not src:
+            urls = find_urls(target.text)
+            if urls:
+                src = download_video_from_url(urls[0])
+        if not src:
+            tg_call("sendMessage", chat_id=m.chat_id, reply_to_message_id=m.id,
+                    text="Прикрепи/ответь на медиа (видео/аудио/voice) или пришли ссылку.")
+            return
+        out = extract_voice_ogg(src)
+        tg_upload("sendVoice", "voice", out, chat_id=m.chat_id, reply_to_message_id=m.id)
+    except MediaRejected as e:
+        tg_call("sendMessage", chat_id=m.chat_id, reply_to_message_id=m.id, text=str(e))
+    except Exception as e:
+        tg_call("sendMessage", chat_id=m.chat_id, reply_to_message_id=m.id, text=f"Ошибка voice: {e}")
 
+def url_job(m: Msg, url: str):
+    """Ссылка в сообщении: скачать видео в пуле, а сохранить и показать кнопки — в url_done"""
+    try:
+        src = download_video_from_url(url)
+    except MediaRejected as e:
+        # ссылку никто не просил обрабатывать — отказ только в лог
+        log_info("media.url_rejected", chat=m.chat_id, url=url, reason=str(e))
+        return
+    if src:
+        media_result(url_done, m, src)
+
+def url_done(m: Msg, src: str):
+    store("", m.chat_id, m.id, m.text, "document", "local:" + src)
+    try:
+        send_media_actions_kb(m.chat_id, m.id)
+    except Exception as e:
+        log_error("kb.error", source="url", error=repr(e))
+
+def button_job(kind: str, src_chat: int, src_msg: int, fid: str):
     if str(fid).startswith("local:"):
         src_path = str(fid)[6:]
     else:
@@ -516,99 +1763,85 @@ def handle_callback_query(u):
         except Exception as e:
             tg_call("sendMessage", chat_id=src_chat, reply_to_message_id=src_msg, text=f"Ошибка voice: {e}")
 
+# ===== callbacks =====
+def answer_callback(cq: dict, text: str | None = None, show_alert: bool = False):
+    """Ответ на нажатие; протухший query (апдейт долго ждал в очереди) не должен ронять обработку"""
+    params = {"callback_query_id": cq.get("id")}
+    if text:
+        params["text"] = text
+    if show_alert:
+        params["show_alert"] = True
+    try:
+        tg_call("answerCallbackQuery", **params)
+    except Exception as e:
+        log_warning("callback.answer_error", error=repr(e))
+
+def handle_callback_query(upd: Update):
+    cq = upd.body
+    data = cq.get("data") or ""
+    try:
+        kind, src_chat, src_msg = data.split(":", 2)
+        src_chat = int(src_chat); src_msg = int(src_msg)
+    except Exception:
+        answer_callback(cq, "Некорректные данные.", show_alert=True)
+        return
+
+    if kind == "s":
+        # s:<search_id>:<page> — листание результатов /search
+        handle_search_callback(cq, src_chat, src_msg)
+        return
+
+    text, mtype, fid = fetch("", src_chat, src_msg)
+    if not fid or (mtype not in ("video", "animation", "document")):
+        answer_callback(cq, "Медиа не найдено или неподдерживаемо.", show_alert=True)
+        return
+    if str(fid).startswith("local:") and os.path.exists(str(fid)[6:]) \
+            and os.path.getsize(str(fid)[6:]) > MEDIA_MAX_MB * 1024 * 1024:
+        answer_callback(cq, f"Файл больше {MEDIA_MAX_MB} МБ, не возьмусь.", show_alert=True)
+        return
+
+    # дедлайн считается от нажатия: у callback_query нет своей даты
+    user_id = (cq.get("from") or {}).get("id")
+    if not submit_media_job(user_id, src_chat, src_msg, time.time() + MEDIA_DEADLINE_SEC,
+                            button_job, kind, src_chat, src_msg, fid):
+        answer_callback(cq, BUSY_TEXT, show_alert=True)
+        return
+    answer_callback(cq, "Готовлю…")
+
 # ===== бизнес: приём/сохранение =====
-def handle_business_message(u):
-    d("[handle_business_message]")
-    bmsg = u.get("business_message") or {}
-    bcid = bmsg.get("business_connection_id")
-    msg  = bmsg.get("message")
-    
-    # Добавляем детальное логирование структуры сообщения
-    d("[business message structure]", {
-        "has_bcid": bool(bcid),
-        "has_msg": bool(msg),
-        "msg_keys": list(msg.keys()) if msg else [],
-        "raw_bmsg": bmsg
-    })
-    
-    # Обрабатываем случай, когда медиа находится прямо в bmsg (не в msg)
-    if bcid and not msg:
-        chat_id = bmsg.get("chat", {}).get("id")
-        msg_id  = bmsg.get("message_id")
-        text    = msg_text(bmsg)  # Ищем текст в bmsg
-        mtype, fid = parse_media(bmsg)  # Ищем медиа в bmsg
-        d("[business message parsed direct]", {"chat": chat_id, "msg": msg_id, "text": text[:50], "media_type": mtype, "file_id": fid[:30] if fid else None})
-        if text or mtype:
-            store(bcid, chat_id, msg_id, text, mtype, fid)
-            try: cache_media_from_message(chat_id, bmsg)
-            except Exception as e: d("[cache on biz]", str(e))
+def handle_business_message(upd: Update):
+    m = upd.message
+    # Медиа бывает как во вложенном "message", так и прямо в теле апдейта — Msg уже разобрал нужное
+    if not upd.bcid:
         return
-    
-    if bcid and msg:
-        chat_id    = msg["chat"]["id"]
-        msg_id     = msg["message_id"]
-        text       = msg_text(msg)
-        mtype, fid = parse_media(msg)
-        d("[business message parsed]", {"chat": chat_id, "msg": msg_id, "text": text[:50], "media_type": mtype, "file_id": fid[:30] if fid else None})
-        if text or mtype:
-            store(bcid, chat_id, msg_id, text, mtype, fid)
-            try: cache_media_from_message(chat_id, msg)
-            except Exception as e: d("[cache on biz]", str(e))
-        return
-    chat_id = (bmsg.get("chat") or {}).get("id")
-    msg_id  = bmsg.get("message_id")
-    text    = (bmsg.get("text") or bmsg.get("caption") or "").strip()
-    if bcid and chat_id and msg_id and text:
-        store(bcid, chat_id, msg_id, text, None, None)
-
-def handle_edited_business_message(u):
-    d("[handle_edited_business_message]")
-    bmsg = u.get("edited_business_message") or {}
-    bcid = bmsg.get("business_connection_id")
-    msg  = bmsg.get("message")
-    if bcid and msg:
-        chat       = msg.get("chat") or {}
-        chat_id    = chat.get("id")
-        msg_id     = msg["message_id"]
-        actor      = msg.get("from") or {}
-        new_text   = msg_text(msg)
-        old_text, _, _ = fetch(bcid, chat_id, msg_id)
-        store(bcid, chat_id, msg_id, new_text, *parse_media(msg))
-
-        actor_html = actor_link(actor, fallback_user_id=chat_id, fallback_name=build_chat_name(chat))
-        old_html   = html_escape(old_text or "")
-        new_html   = html_escape(new_text or "")
-
-        html = (
-            "✏️ <b>Изменено сообщение</b>\n"
-            f"🤡 {actor_html}\n\n"
-            f"— Было:\n<code>{old_html}</code>\n\n"
-            f"— Стало:\n<code>{new_text}</code>"
-        )
-        send_log_html(html)
-        return
-    chat = bmsg.get("chat") or {}
-    chat_id   = chat.get("id")
-    msg_id    = bmsg.get("message_id")
-    actor     = bmsg.get("from") or {}
-    new_text  = (bmsg.get("text") or bmsg.get("caption") or "").strip()
-    old_text, _, _ = fetch(bcid or "", chat_id or 0, msg_id or 0)
-    if new_text:
-        store(bcid or "", chat_id or 0, msg_id or 0, new_text, None, None)
-    actor_html = actor_link(actor, fallback_user_id=chat_id, fallback_name=build_chat_name(chat))
+    if LOG_DEBUG_ON:
+        log(LOG_DEBUG, "business_message.parsed", chat=m.chat_id, msg=m.id, text=m.text[:50], media_type=m.media_type)
+    if m.text or m.media_type:
+        store(upd.bcid, m.chat_id, m.id, m.text, m.media_type, m.file_id)
+        try: cache_media_from_message(m)
+        except Exception as e: log_warning("cache.on_biz_error", error=repr(e))
+
+def handle_edited_business_message(upd: Update):
+    m    = upd.message
+    bcid = upd.bcid or ""
+    old_text, _, _ = fetch(bcid, m.chat_id or 0, m.id or 0)
+    if upd.bcid and upd.nested:
+        store_edit(bcid, m.chat_id, m.id, m.text, m.media_type, m.file_id)
+    elif m.text or m.media_type:
+        store_edit(bcid, m.chat_id or 0, m.id or 0, m.text, m.media_type, m.file_id)
+    actor_html = user_link(m.sender_id, m.sender_name, fallback_user_id=m.chat_id, fallback_name=m.chat_name)
     old_html   = html_escape(old_text or "")
-    new_html   = html_escape(new_text or "(контент недоступен)")
+    new_html   = html_escape(m.text or "(контент недоступен)")
     html = (
         "✏️ <b>Изменено сообщение</b>\n"
         f"🤡 {actor_html}\n\n"
         f"— Было:\n<code>{old_html}</code>\n\n"
-        f"— Стало:\n<code>{new_text}</code>"
+        f"— Стало:\n<code>{new_html}</code>"
     )
     send_log_html(html)
 
-def handle_deleted_business_messages(u):
-    d("[handle_deleted_business_messages]")
-    d_msg   = u.get("deleted_business_messages") or {}
+def handle_deleted_business_messages(upd: Update):
+    d_msg   = upd.body
     bcid    = d_msg.get("business_connection_id")
     chat    = d_msg.get("chat") or {}
     chat_id = chat.get("id")
@@ -640,7 +1873,7 @@ def handle_deleted_business_messages(u):
                     tg_call("sendMessage", chat_id=get_owner_id() or LOG_CHAT, text=caption, parse_mode="HTML", disable_web_page_preview=True)
                     tg_call("sendVideoNote", chat_id=get_owner_id() or LOG_CHAT, video_note=fid, length=640)
                 except Exception as e:
-                    d("[video_note error]", str(e))
+                    log_error("video_note.error", error=repr(e))
                     send_log_html(caption + "\n\n<i>(не удалось отправить кружок)</i>")
             else:
                 send_media_to_log(mtype, fid, caption)
@@ -648,18 +1881,17 @@ def handle_deleted_business_messages(u):
             # Текстовое сообщение без медиа - отправляем только текст
             send_log_html(caption)
         else:
-            d("[deleted miss] not in DB", {"chat": chat_id, "msg": mid})
+            log_info("deleted.miss", chat=chat_id, msg=mid)
             sent = try_send_from_cache(chat_id, mid, caption)
             if not sent:
                 send_log_html(caption + "\n\n<i>(не нашли медиа в БД/кэше для message_id=" + str(mid) + ")</i>")
 
-def handle_business_connection(u):
-    d("[handle_business_connection]")
+def handle_business_connection(upd: Update):
+    log_info("business_connection", id=upd.body.get("id"))
     # без действий
 
-def handle_deleted_messages(u):
-    d("[handle_deleted_messages]")
-    d_msg   = u.get("deleted_messages") or {}
+def handle_deleted_messages(upd: Update):
+    d_msg   = upd.body
     chat    = d_msg.get("chat") or {}
     chat_id = chat.get("id")
     actor   = d_msg.get("from") or {}
@@ -696,7 +1928,7 @@ def handle_deleted_messages(u):
                 tg_upload("sendVideoNote", "video_note", muted, chat_id=get_owner_id(), length=640)
                 continue
             except Exception as e:
-                d("[video_note muted error]", str(e))
+                log_error("video_note.muted_error", error=repr(e))
                 # фолбэк: попробуем из кэша или хотя бы текст
                 if try_send_from_cache(chat_id, mid, caption):
                     continue
@@ -710,50 +1942,45 @@ def handle_deleted_messages(u):
             # Текстовое сообщение без медиа - отправляем только текст
             send_log_html(caption)
         else:
-            d("[deleted miss] not in DB", {"chat": chat_id, "msg": mid})
+            log_info("deleted.miss", chat=chat_id, msg=mid)
             sent = try_send_from_cache(chat_id, mid, caption)
             if not sent:
                 send_log_html(caption + "\n\n<i>(не нашли медиа в БД/кэше для message_id=" + str(mid) + ")</i>")
 
 # ===== обычные чаты + кнопки/команды =====
-def handle_message(u):
-    d("[handle_message]")
-    m = u.get("message")
-    if not m: return
-    chat_id = (m.get("chat") or {}).get("id")
-    msg_id  = m.get("message_id")
-    text       = msg_text(m)
-    mtype, fid = parse_media(m)
-    kb_sent = False
-
-    # --- ссылка на видео: скачать и показать кнопки ---
-    if (not mtype) and text:
+def handle_message(upd: Update):
+    m = upd.message
+    chat_id    = m.chat_id
+    msg_id     = m.id
+    text       = m.text
+    mtype, fid = m.media_type, m.file_id
+    url_queued = False
+
+    # --- ссылка на видео: скачать в фоне и показать кнопки (у команд ссылку разбирает сама команда) ---
+    if (not mtype) and text and not text.startswith(("/", "!")):
         urls = find_urls(text)
         if urls:
-            src = download_video_from_url(urls[0])
-            if src:
-                mtype = "document"
-                fid = "local:" + src
-                store("", chat_id, msg_id, text, mtype, fid)
-                try:
-                    send_media_actions_kb(chat_id, msg_id)
-                    kb_sent = True
-                except Exception as e:
-                    d("[kb error/url]", str(e))
-
-    # --- медиа: показать кнопки (если ещё не отправили) ---
-    if (mtype in ("video", "animation", "document")) and (not kb_sent):
+            # текст сохраняем сразу, задача потом дополнит запись скачанным файлом;
+            # при перегрузе ссылка просто остаётся без кнопок — отвечать на каждую ссылку в чате незачем
+            store("", chat_id, msg_id, text, None, None)
+            url_queued = True
+            submit_media_job(m.sender_id, chat_id, None, (m.date or time.time()) + MEDIA_DEADLINE_SEC,
+                             url_job, m, urls[0])
+
+    # --- медиа: показать кнопки (слишком большое всё равно не обработать — кнопок не будет) ---
+    if mtype in ("video", "animation", "document"):
         store("", chat_id, msg_id, text, mtype, fid)
-        try: cache_media_from_message(chat_id, m)
-        except Exception as e: d("[cache on message error]", str(e))
-        try:
-            send_media_actions_kb(chat_id, msg_id)
-        except Exception as e:
-            d("[kb error]", str(e))
+        try: cache_media_from_message(m)
+        except Exception as e: log_warning("cache.on_message_error", error=repr(e))
+        if not media_too_big(m):
+            try:
+                send_media_actions_kb(chat_id, msg_id)
+            except Exception as e:
+                log_error("kb.error", error=repr(e))
 
     # --- команды ---
     if text and text.startswith("/start"):
-        user_id = (m.get("from") or {}).get("id")
+        user_id = m.sender_id
         if user_id:
             current_owner = get_owner_id()
             if not current_owner:
@@ -767,7 +1994,7 @@ def handle_message(u):
         return
 
     if text and text.startswith("/owner"):
-        user_id = (m.get("from") or {}).get("id")
+        user_id = m.sender_id
         if user_id:
             current_owner = get_owner_id()
             if str(user_id) == current_owner:
@@ -783,124 +2010,425 @@ def handle_message(u):
                 tg_call("sendMessage", chat_id=chat_id, text=f"❌ Ты не владелец бота.\n👑 Текущий владелец: `{current_owner}`", parse_mode="Markdown")
         return
 
-    if text and (text.startswith("!circle") or text.startswith("/circle")):
+    if text and text.startswith("/search"):
         try:
-            reply = m.get("reply_to_message")
-            target = reply or m
-            src = ensure_local_video_from_message(target)
-            if not src:
-                urls = find_urls(msg_text(target))
-                if urls:
-                    src = download_video_from_url(urls[0])
-            if not src:
-                tg_call("sendMessage", chat_id=chat_id, reply_to_message_id=msg_id,
-                        text="Прикрепи или ответь на видео/анимацию/документ с видео (или пришли ссылку).")
-                return
-            out = make_video_note_square(src)
-            tg_upload("sendVideoNote", "video_note", out, chat_id=chat_id, reply_to_message_id=msg_id, length=640)
-        except Exception as e:
-            tg_call("sendMessage", chat_id=chat_id, reply_to_message_id=msg_id, text=f"Ошибка circle: {e}")
+            handle_search_command(m)
+        except sqlite3.Error as e:
+            tg_call("sendMessage", chat_id=chat_id, reply_to_message_id=msg_id, text=f"Ошибка поиска: {e}")
+        return
+
+    if text and text.startswith("/history"):
+        handle_history_command(m)
+        return
+
+    if text and (text.startswith("!circle") or text.startswith("/circle")):
+        start_media_command(m, circle_job)
         return
 
     if text and (text.startswith("!voice") or text.startswith("/voice")):
-        try:
-            reply = m.get("reply_to_message")
-            target = reply or m
-            src = ensure_local_video_from_message(target)
-            if not src and "audio" in target:
-                url, fname = get_file_path(target["audio"]["file_id"]); src = download_file(url, fname)
-            if not src and "voice" in target:
-                url, fname = get_file_path(target["voice"]["file_id"]); src = download_file(url, fname)
-            if not src:
-                urls = find_urls(msg_text(target))
-                if urls:
-                    src = download_video_from_url(urls[0])
-            if not src:
-                tg_call("sendMessage", chat_id=chat_id, reply_to_message_id=msg_id,
-                        text="Прикрепи/ответь на медиа (видео/аудио/voice) или пришли ссылку.")
-                return
-            out = extract_voice_ogg(src)
-            tg_upload("sendVoice", "voice", out, chat_id=chat_id, reply_to_message_id=msg_id)
-        except Exception as e:
-            tg_call("sendMessage", chat_id=chat_id, reply_to_message_id=msg_id, text=f"Ошибка voice: {e}")
+        start_media_command(m, voice_job)
         return
 
     # --- обычное сохранение ---
-    if text or mtype:
+    if (text or mtype) and not url_queued:
         store("", chat_id, msg_id, text, mtype, fid)
         if mtype and mtype in ("photo","voice","audio","video_note"):
-            try: cache_media_from_message(chat_id, m)
-            except Exception as e: d("[cache on message minor]", str(e))
-
-def handle_edited_message(u):
-    d("[handle_edited_message]")
-    em = u.get("edited_message")
-    if not em: return
-    chat     = em.get("chat") or {}
-    chat_id  = chat.get("id")
-    msg_id   = em.get("message_id")
-    actor    = em.get("from") or {}
-    new_text  = msg_text(em)
-    old_text, _, _ = fetch("", chat_id, msg_id)
-    store("", chat_id, msg_id, new_text, *parse_media(em))
-    actor_html = actor_link(actor, fallback_user_id=chat_id, fallback_name=build_chat_name(chat))
+            try: cache_media_from_message(m)
+            except Exception as e: log_warning("cache.on_message_error", error=repr(e))
+
+def handle_edited_message(upd: Update):
+    m = upd.message
+    old_text, _, _ = fetch("", m.chat_id, m.id)
+    store_edit("", m.chat_id, m.id, m.text, m.media_type, m.file_id)
+    actor_html = user_link(m.sender_id, m.sender_name, fallback_user_id=m.chat_id, fallback_name=m.chat_name)
     old_html   = html_escape(old_text or "")
-    new_html   = html_escape(new_text or "")
+    new_html   = html_escape(m.text or "(контент недоступен)")
     html = (
         "✏️ <b>Изменено сообщение</b>\n"
         f"🤡 {actor_html}\n\n"
         f"— Было:\n<code>{old_html}</code>\n\n"
-        f"— Стало:\n<code>{new_text}</code>"
+        f"— Стало:\n<code>{new_html}</code>"
     )
     send_log_html(html)
 
+# вид апдейта -> обработчик; в апдейте Telegram ровно одно поле с телом
+UPDATE_HANDLERS = {
+    "callback_query":            handle_callback_query,
+    "business_message":          handle_business_message,
+    "edited_business_message":   handle_edited_business_message,
+    "deleted_business_messages": handle_deleted_business_messages,
+    "business_connection":       handle_business_connection,
+    "deleted_messages":          handle_deleted_messages,
+    "edited_message":            handle_edited_message,
+    "message":                   handle_message,
+}
+
+def dispatch_update(raw: dict):
+    upd = decode_update(raw)
+    if upd is None:
+        log_debug("update.skip", keys=lambda: list(raw))
+        return
+    UPDATE_HANDLERS[upd.kind](upd)
+
+# ===== durable inbox =====
+# Пачка getUpdates сначала целиком пишется в очередь одной транзакцией вместе с новым offset,
+# и только потом offset уходит в Telegram (= подтверждение). Обработанные апдейты удаляются
+# из очереди, упавшие повторяются с задержкой, после INBOX_MAX_ATTEMPTS уходят в inbox_dead.
+def connect_inbox() -> sqlite3.Connection:
+    conn = sqlite3.connect(INBOX_DB, timeout=30, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+inbox_db = connect_inbox()
+inbox_db.execute("""
+CREATE TABLE IF NOT EXISTS inbox(
+  update_id  INTEGER PRIMARY KEY,
+  payload    TEXT,
+  state      INTEGER DEFAULT 0,   -- 0 ждёт обработки, 1 взят в работу
+  attempts   INTEGER DEFAULT 0,
+  next_try   INTEGER DEFAULT 0,   -- не раньше этого времени (повтор после ошибки)
+  claimed_at INTEGER,
+  last_error TEXT
+)
+""")
+inbox_db.execute("""
+CREATE TABLE IF NOT EXISTS inbox_dead(
+  update_id  INTEGER PRIMARY KEY,
+  payload    TEXT,
+  attempts   INTEGER,
+  last_error TEXT,
+  failed_at  INTEGER
+)
+""")
+inbox_db.execute("CREATE TABLE IF NOT EXISTS inbox_state(key TEXT PRIMARY KEY, value)")
+if "shard" not in {r[1] for r in inbox_db.execute("PRAGMA table_info(inbox)").fetchall()}:
+    inbox_db.execute("ALTER TABLE inbox ADD COLUMN shard INTEGER DEFAULT 0")
+inbox_db.execute("CREATE INDEX IF NOT EXISTS idx_inbox_shard ON inbox(shard, update_id)")
+if "chat_key" not in {r[1] for r in inbox_db.execute("PRAGMA table_info(inbox)").fetchall()}:
+    inbox_db.execute("ALTER TABLE inbox ADD COLUMN chat_key TEXT DEFAULT ''")
+    _backfill_chat_key = True
+else:
+    _backfill_chat_key = False
+inbox_db.execute("CREATE INDEX IF NOT EXISTS idx_inbox_chat ON inbox(chat_key, update_id)")
+inbox_db.commit()
+
+def update_chat_key(upd: dict) -> str:
+    """Ключ шардирования: id чата, а если его нет — business_connection_id"""
+    body = next((v for k, v in upd.items() if k != "update_id" and isinstance(v, dict)), {})
+    if "callback_query" in upd:
+        body = body.get("message") or {}
+    chat = body.get("chat") or (body.get("message") or {}).get("chat") or {}
+    if chat.get("id"):
+        return str(chat["id"])
+    # business_connection: id самого подключения
+    return str(body.get("business_connection_id") or body.get("id") or "")
+
+def shard_of_key(key: str, shards: int) -> int:
+    # crc32, а не hash(): hash строк случаен в каждом процессе
+    return zlib.crc32(key.encode("utf-8")) % shards if shards > 1 else 0
+
+if _backfill_chat_key:   # очередь, записанная до появления chat_key
+    with inbox_db:
+        inbox_db.executemany("UPDATE inbox SET chat_key=? WHERE update_id=?", [
+            (update_chat_key(json_loads(payload)), uid)
+            for uid, payload in inbox_db.execute("SELECT update_id, payload FROM inbox").fetchall()
+        ])
+
+def load_offset() -> int | None:
+    row = inbox_db.execute("SELECT value FROM inbox_state WHERE key='offset'").fetchone()
+    return int(row[0]) if row else None
+
+def enqueue_updates(updates: list, offset: int | None, conn: sqlite3.Connection | None = None) -> int | None:
+    """Сохраняет пачку и новый offset одной транзакцией; возвращает offset для следующего getUpdates"""
+    if not updates:
+        return offset
+    conn = conn or inbox_db
+    for upd in updates:
+        offset = max(offset or 0, upd.get("update_id", 0) + 1)
+    rows = []
+    for upd in updates:
+        key = update_chat_key(upd)
+        rows.append((upd.get("update_id"), json.dumps(upd, ensure_ascii=False), shard_of_key(key, WORKERS), key))
+    with conn:
+        conn.executemany("INSERT OR IGNORE INTO inbox(update_id, payload, shard, chat_key) VALUES(?,?,?,?)", rows)
+        conn.execute("INSERT OR REPLACE INTO inbox_state(key, value) VALUES('offset', ?)", (offset,))
+    for upd in updates:
+        log_json(RAW_UPDATES, {"ts": _ts(), **upd})
+    return offset
+
+def recover_inbox(shard: int | None = None):
+    """Апдейты, взятые в работу упавшим процессом, снова становятся в очередь (at-least-once)"""
+    with inbox_db:
+        if shard is None:
+            n = inbox_db.execute("UPDATE inbox SET state=0 WHERE state=1").rowcount
+        else:
+            n = inbox_db.execute("UPDATE inbox SET state=0 WHERE state=1 AND shard=?", (shard,)).rowcount
+    if n:
+        log_warning("inbox.recovered", count=n, shard=shard)
+
+def reshard_inbox(shards: int):
+    """Пересчитывает шарды ожидающих апдейтов, если число обработчиков поменялось"""
+    moved = []
+    for uid, key, old in inbox_db.execute("SELECT update_id, chat_key, shard FROM inbox").fetchall():
+        new = shard_of_key(key, shards)
+        if new != old:
+            moved.append((new, uid))
+    if moved:
+        with inbox_db:
+            inbox_db.executemany("UPDATE inbox SET shard=? WHERE update_id=?", moved)
+
+# Апдейт чата не берётся, пока в очереди есть более ранний апдейт того же чата (ждёт повтора
+# после ошибки или ещё в работе): иначе после первой же ошибки порядок внутри чата ломается.
+# Апдейты без ключа чата ('') друг друга не ждут.
+INBOX_HEAD = ("(i.chat_key = '' OR NOT EXISTS (SELECT 1 FROM inbox j "
+              "WHERE j.chat_key = i.chat_key AND j.update_id < i.update_id))")
+
+def claim_update(shard: int | None = None):
+    now = int(time.time())
+    where, args = "state=0 AND next_try<=? AND " + INBOX_HEAD, [now]
+    if shard is not None:
+        where += " AND shard=?"; args.append(shard)
+    with inbox_db:
+        return inbox_db.execute(
+            "UPDATE inbox SET state=1, attempts=attempts+1, claimed_at=? WHERE update_id=("
+            f"SELECT update_id FROM inbox i WHERE {where} ORDER BY update_id LIMIT 1"
+            ") RETURNING update_id, payload, attempts",
+            (now, *args)
+        ).fetchone()
+
+def complete_update(update_id: int):
+    with inbox_db:
+        inbox_db.execute("DELETE FROM inbox WHERE update_id=?", (update_id,))
+
+def fail_update(update_id: int, attempts: int, error: str):
+    now = int(time.time())
+    with inbox_db:
+        if attempts >= INBOX_MAX_ATTEMPTS:
+            inbox_db.execute(
+                "INSERT OR REPLACE INTO inbox_dead(update_id, payload, attempts, last_error, failed_at) "
+                "SELECT update_id, payload, attempts, ?, ? FROM inbox WHERE update_id=?",
+                (error, now, update_id)
+            )
+            inbox_db.execute("DELETE FROM inbox WHERE update_id=?", (update_id,))
+        else:
+            inbox_db.execute(
+                "UPDATE inbox SET state=0, next_try=?, last_error=? WHERE update_id=?",
+                (now + min(300, 2 ** attempts), error, update_id)
+            )
+
+def inbox_next_due() -> int | None:
+    """Через сколько секунд станет доступен следующий повтор (None — очередь пуста)"""
+    # только головы чатов: апдейты за ними ждут не своего next_try, а обработки головы
+    row = inbox_db.execute(f"SELECT MIN(next_try) FROM inbox i WHERE state=0 AND {INBOX_HEAD}").fetchone()
+    if not row or row[0] is None:
+        return None
+    return max(0, row[0] - int(time.time()))
+
+def drain_inbox(shard: int | None = None, heartbeat=None):
+    while True:
+        if heartbeat is not None:
+            heartbeat.value = time.time()
+        apply_media_results()
+        item = claim_update(shard)
+        if not item:
+            return
+        update_id, payload, attempts = item
+        upd = json_loads(payload)
+        try:
+            dispatch_update(upd)
+        except Exception as e:
+            log_error("update.error", update_id=update_id, attempt=attempts, error=repr(e), upd=payload[:800])
+            fail_update(update_id, attempts, repr(e))
+            if attempts >= INBOX_MAX_ATTEMPTS:
+                log_error("inbox.dead_letter", update_id=update_id)
+            continue
+        complete_update(update_id)
+
+# ===== supervisor / worker processes =====
+# WORKERS > 1: главный процесс только опрашивает Telegram и пишет в inbox, а апдейты
+# обрабатывают N процессов, каждый — свой шард (crc32 ключа чата % N). Один чат всегда
+# попадает в один процесс, поэтому порядок внутри чата сохраняется.
+# Процессы запускаются через spawn, а не fork: к моменту (пере)запуска в родителе уже работают
+# поток логов, Poller с запросом в полёте и, возможно, открытая транзакция SQLite. Дочерний
+# процесс заново импортирует модуль и открывает собственные соединения с базами.
+_mp = multiprocessing.get_context("spawn")
+
+def worker_main(shard: int, heartbeat, wake):
+    global _media_wake
+    _media_wake = wake.set
+    recover_inbox(shard)
+    log_info("worker.started", shard=shard)
+    while True:
+        try:
+            drain_inbox(shard, heartbeat)
+        except Exception as e:
+            log_error("worker.error", shard=shard, error=repr(e)); time.sleep(1)
+        heartbeat.value = time.time()
+        if wake.wait(1.0):
+            wake.clear()
+
+class WorkerPool:
+    def __init__(self, shards: int):
+        self.shards  = shards
+        self.procs   = [None] * shards
+        self.beats   = [_mp.Value("d", 0.0) for _ in range(shards)]
+        self.wakes   = [_mp.Event() for _ in range(shards)]
+
+    def start(self, shard: int):
+        self.beats[shard].value = time.time()
+        p = _mp.Process(target=worker_main, args=(shard, self.beats[shard], self.wakes[shard]),
+                                    name=f"worker-{shard}", daemon=True)
+        p.start()
+        self.procs[shard] = p
+
+    def start_all(self):
+        for shard in range(self.shards):
+            self.start(shard)
+        threading.Thread(target=self.monitor, name="worker-monitor", daemon=True).start()
+
+    def wake_all(self):
+        for ev in self.wakes:
+            ev.set()
+
+    def check(self):
+        """Перезапускает упавшие и зависшие обработчики; их незавершённые апдейты вернёт recover_inbox"""
+        for shard, p in enumerate(self.procs):
+            if not p.is_alive():
+                log_error("worker.exited", shard=shard, exitcode=p.exitcode)
+            elif time.time() - self.beats[shard].value > WORKER_STALL_SEC:
+                log_error("worker.stalled", shard=shard, stall_sec=WORKER_STALL_SEC)
+                p.terminate()
+                p.join(10)
+                if p.is_alive():
+                    p.kill(); p.join()
+            else:
+                continue
+            self.start(shard)
+
+    def monitor(self):
+        while True:
+            time.sleep(5)
+            try:
+                self.check()
+            except Exception as e:
+                log_error("worker.monitor_error", error=repr(e))
+
+# ===== опрос Telegram в отдельном потоке =====
+# Poller держит один long poll постоянно в полёте, пока основной поток (или процессы-обработчики)
+# разбирает предыдущую пачку: сеть и обработка больше не ждут друг друга. Очередь между ними —
+# тот же inbox: пачка пишется туда вместе с offset, и только после этого offset уходит в Telegram
+# следующим запросом. Очередь ограничена INBOX_HIGH_WATER: когда она полна, опрос встаёт на паузу,
+# и новые апдейты ждут на стороне Telegram, а не копятся в памяти.
+class Poller:
+    def __init__(self, offset: int | None, on_batch):
+        self.offset   = offset
+        self.on_batch = on_batch
+        self.room     = threading.Event()   # обработчик освободил место в очереди
+        self.conn     = connect_inbox()     # своё соединение: транзакции потоков не перемешиваются
+
+    def backlog(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM inbox").fetchone()[0]
+
+    def start(self):
+        threading.Thread(target=self.run, name="poller", daemon=True).start()
+
+    def run(self):
+        # пустой список — получить все типы апдейтов (включая бизнес-удаления)
+        allowed = json.dumps([])
+        full = paused = False
+        while True:
+            try:
+                room = INBOX_HIGH_WATER - self.backlog()
+                # гистерезис: после паузы ждём, пока очередь разгрузится хотя бы наполовину
+                if room <= 0 or (paused and room < INBOX_HIGH_WATER // 2):
+                    if not paused:
+                        log_warning("poll.backpressure", backlog=INBOX_HIGH_WATER - room)
+                        paused = True
+                    self.room.clear()
+                    self.room.wait(1)
+                    continue
+                if paused:
+                    log_info("poll.resumed", backlog=INBOX_HIGH_WATER - room)
+                    paused = False
+                # limit не больше свободного места; после полной пачки в Telegram точно есть ещё —
+                # спрашиваем без ожидания, иначе обычный long poll
+                limit   = min(POLL_LIMIT, room)
+                timeout = 0 if full else POLL_TIMEOUT
+                r = requests.post(f"{API}/getUpdates", data={
+                    "offset": self.offset or "", "limit": limit, "timeout": timeout, "allowed_updates": allowed
+                }, timeout=(10, timeout + 5))
+                r.raise_for_status()
+                data = json_loads(r.content)
+                if not data.get("ok"):
+                    time.sleep(2); continue
+                batch = data.get("result") or []
+                full = len(batch) >= limit
+                if batch:
+                    self.offset = enqueue_updates(batch, self.offset, self.conn)
+                    self.on_batch()
+            except requests.exceptions.RequestException as e:
+                log_warning("poll.network_error", error=str(e)); time.sleep(2)
+            except Exception as e:
+                log_error("poll.loop_error", error=repr(e)); time.sleep(2)
+
 # ===== main loop =====
 def main():
-    offset = None
-    # пустой список — получить все типы апдейтов (включая бизнес-удаления)
-    allowed = json.dumps([])
+    global _media_wake
+    offset = load_offset()
     send_log_html("✅ Бот запущен.")
     try:
         cleanup_cache()
     except Exception as e:
-        d("[cache cleanup error]", str(e))
-    print("poll started...")
+        log_error("cache.cleanup_error", error=repr(e))
+    recover_inbox()
+    pool = None
+    if WORKERS > 1:
+        reshard_inbox(WORKERS)
+        pool = WorkerPool(WORKERS)
+        pool.start_all()
+    else:
+        drain_inbox()
+    wake = threading.Event()
+    _media_wake = wake.set
+    poller = Poller(offset, pool.wake_all if pool else wake.set)
+    poller.start()
+    log_info("poll.started", workers=WORKERS if pool else 1)
     while True:
         try:
-            r = requests.post(f"{API}/getUpdates", data={
-                "offset": offset or "", "timeout": POLL_TIMEOUT, "allowed_updates": allowed
-            }, timeout=(10, POLL_TIMEOUT + 5))
-            r.raise_for_status()
-            data = r.json()
-            if not data.get("ok"):
-                time.sleep(2); continue
-            for upd in (data.get("result") or []):
-                offset = max(offset or 0, upd.get("update_id", 0) + 1)
-                log_json(RAW_UPDATES, {"ts": _ts(), **upd})
-                try:
-                    if   "callback_query"             in upd: handle_callback_query(upd)
-                    elif "business_message"           in upd: handle_business_message(upd)
-                    elif "edited_business_message"    in upd: handle_edited_business_message(upd)
-                    elif "deleted_business_messages"  in upd: handle_deleted_business_messages(upd)
-                    elif "business_connection"        in upd: handle_business_connection(upd)
-                    elif "deleted_messages"           in upd: handle_deleted_messages(upd)
-                    elif "edited_message"             in upd: handle_edited_message(upd)
-                    elif "message"                    in upd: handle_message(upd)
-                    else:
-                        d("[skip update]", list(upd.keys()))
-                except Exception as e:
-                    try: j = json.dumps(upd, ensure_ascii=False)[:800]
-                    except: j = str(upd)[:800]
-                    print("handle error:", repr(e), "upd:", j)
-        except requests.exceptions.RequestException as e:
-            print("network error:", e); time.sleep(2)
+            # ждём новую пачку от Poller, но не дольше, чем до ближайшего повтора в очереди
+            due = inbox_next_due() if pool is None else None
+            wake.wait(POLL_TIMEOUT if due is None else due)
+            wake.clear()
+            if pool is None:
+                drain_inbox()
+            poller.room.set()
+            try:
+                maintenance_tick()
+            except Exception as e:
+                log_error("maintenance.error", error=repr(e))
         except Exception as e:
-            print("loop error:", repr(e)); time.sleep(2)
+            log_error("main.loop_error", error=repr(e)); time.sleep(2)
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["bench-codec"]:
+        bench_codec()
+        sys.exit(0)
+    if sys.argv[1:2] == ["bench-decode"]:
+        bench_decode(*sys.argv[2:3])
+        sys.exit(0)
+    if sys.argv[1:2] == ["enable-incremental-vacuum"]:
+        enable_incremental_vacuum()
+        print("auto_vacuum:", db.execute("PRAGMA auto_vacuum").fetchone()[0])
+        sys.exit(0)
+    if sys.argv[1:2] == ["rebuild-media-index"]:
+        print("files indexed:", rebuild_media_index())
+        sys.exit(0)
+    if sys.argv[1:2] == ["train-codec"]:
+        print("dictionary:", train_text_dict())
+        sys.exit(0)
     try:
         me = tg_call("getMe")
-        d("[getMe]", {"id": me.get("id"), "username": me.get("username")})
+        log_info("getMe", id=me.get("id"), username=me.get("username"))
     except Exception as e:
-        print("[diag getMe error]", e)
+        log_error("getMe.error", error=repr(e))
     main()